@@ -0,0 +1,235 @@
+"""Benchmark of the reference graphs on synthetic data.
+
+Generates a text corpus with Zipfian vocabulary and road edges with travel
+times, runs word count, tf-idf, pmi and yandex maps graphs on them at
+several scales, each run in its own process to measure peak RSS, and writes
+results as JSON:
+
+    python benchmark.py --scales 1000,10000 --output results.json
+    python benchmark.py --compare results.json --output new.json
+
+With --compare results are checked against a stored baseline and the exit
+code is 1 if any graph got slower or bigger than the threshold allows.
+"""
+import argparse
+import datetime
+import importlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+if __package__:
+    from . import graphs
+else:
+    # run as a script: import the project as a package from its parent
+    _root = os.path.dirname(os.path.realpath(__file__))
+    sys.path.insert(0, os.path.dirname(_root))
+    graphs = importlib.import_module(os.path.basename(_root) + '.graphs')
+
+
+GRAPHS = ['word_count', 'tf_idf', 'pmi', 'yandex_maps']
+
+
+def make_vocabulary(size: int, rng: random.Random):
+    """Distinct lowercase words of 2 to 10 letters"""
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters)
+                          for _ in range(rng.randint(2, 10))))
+    return sorted(words)
+
+
+def generate_corpus(path: str, docs: int, seed: int = 0,
+                    vocabulary_size: int = 10000, exponent: float = 1.1):
+    """Documents with words drawn from Zipf distribution, some of them
+    capitalized or followed by punctuation"""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, vocabulary_size + 1):
+        total += 1 / rank ** exponent
+        cum_weights.append(total)
+    with open(path, 'w') as f:
+        for doc_id in range(docs):
+            words = rng.choices(vocabulary, cum_weights=cum_weights,
+                                k=rng.randint(5, 60))
+            for index, word in enumerate(words):
+                if rng.random() < 0.1:
+                    words[index] = word.capitalize()
+                if rng.random() < 0.1:
+                    words[index] += rng.choice('.,!?')
+            f.write(json.dumps({'doc_id': doc_id, 'text': ' '.join(words)}))
+            f.write('\n')
+
+
+def generate_roads(lengths_path: str, times_path: str, edges: int,
+                   trips_per_edge: int = 5, seed: int = 0):
+    """Road edges around Moscow and travel times over random edges"""
+    rng = random.Random(seed)
+    edge_ids = rng.sample(range(1, 1 << 63), edges)
+    with open(lengths_path, 'w') as f:
+        for edge_id in edge_ids:
+            start = [rng.uniform(37.3, 37.9), rng.uniform(55.5, 55.9)]
+            end = [start[0] + rng.uniform(-0.002, 0.002),
+                   start[1] + rng.uniform(-0.002, 0.002)]
+            f.write(json.dumps({'start': start, 'end': end,
+                                'edge_id': edge_id}))
+            f.write('\n')
+    month = datetime.datetime(2017, 10, 1)
+    with open(times_path, 'w') as f:
+        for _ in range(edges * trips_per_edge):
+            enter = month + datetime.timedelta(
+                seconds=rng.uniform(0, 30 * 24 * 3600))
+            leave = enter + datetime.timedelta(seconds=rng.uniform(1, 30))
+            f.write(json.dumps({
+                'enter_time': enter.strftime('%Y%m%dT%H%M%S.%f'),
+                'leave_time': leave.strftime('%Y%m%dT%H%M%S.%f'),
+                'edge_id': rng.choice(edge_ids)}))
+            f.write('\n')
+
+
+def build_graph(name: str):
+    """Graph and names of its data sources"""
+    if name == 'word_count':
+        return graphs.word_count_graph('corpus', text_column='text',
+                                       count_column='count',
+                                       from_file=True), ['corpus']
+    if name == 'tf_idf':
+        return graphs.inverted_index_graph('corpus', doc_column='doc_id',
+                                           text_column='text',
+                                           result_column='tf_idf',
+                                           from_file=True), ['corpus']
+    if name == 'pmi':
+        return graphs.pmi_graph('corpus', doc_column='doc_id',
+                                text_column='text', result_column='pmi',
+                                from_file=True), ['corpus']
+    if name == 'yandex_maps':
+        return graphs.yandex_maps_graph(
+            'times', 'lengths',
+            enter_time_column='enter_time', leave_time_column='leave_time',
+            edge_id_column='edge_id',
+            start_coord_column='start', end_coord_column='end',
+            weekday_result_column='weekday', hour_result_column='hour',
+            speed_result_column='speed', from_file=True
+        ), ['times', 'lengths']
+    raise ValueError('unknown graph {!r}'.format(name))
+
+
+def prepare_data(directory: str, scale: int):
+    """Paths of generated data sources for the scale, generated once"""
+    paths = {name: os.path.join(directory, '{}_{}.txt'.format(name, scale))
+             for name in ('corpus', 'lengths', 'times')}
+    if not os.path.exists(paths['corpus']):
+        generate_corpus(paths['corpus'], docs=scale)
+    if not os.path.exists(paths['times']):
+        generate_roads(paths['lengths'], paths['times'], edges=scale)
+    return paths
+
+
+def run_one(name: str, scale: int, directory: str) -> dict:
+    """Run graph in this process; peak RSS covers the whole process"""
+    paths = prepare_data(directory, scale)
+    graph, sources = build_graph(name)
+    start = time.perf_counter()
+    rows = sum(1 for _ in graph.run_iter(**{source: paths[source]
+                                            for source in sources}))
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return {'graph': name, 'scale': scale, 'seconds': seconds,
+            'peak_rss_kb': peak_rss, 'rows': rows}
+
+
+def run_isolated(name: str, scale: int, directory: str) -> dict:
+    """Run graph in a separate process so that peak RSS is its own"""
+    prepare_data(directory, scale)
+    output = subprocess.run(
+        [sys.executable, os.path.realpath(__file__), '--run-one', name,
+         '--scales', str(scale), '--data-dir', directory],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output)
+
+
+def compare(results, baseline, threshold: float):
+    """Descriptions of results worse than baseline by more than threshold
+    (relative) in time or peak RSS"""
+    stored = {(result['graph'], result['scale']): result
+              for result in baseline}
+    regressions = []
+    for result in results:
+        old = stored.get((result['graph'], result['scale']))
+        if old is None:
+            continue
+        for metric in ('seconds', 'peak_rss_kb'):
+            if result[metric] > old[metric] * (1 + threshold):
+                regressions.append('{} at scale {}: {} {:.4g} -> {:.4g}'
+                                   .format(result['graph'], result['scale'],
+                                           metric, old[metric],
+                                           result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', default='1000,10000',
+                        help='comma separated numbers of documents and '
+                             'road edges')
+    parser.add_argument('--graphs', default=','.join(GRAPHS),
+                        help='comma separated graphs to run')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of every graph; the fastest is kept')
+    parser.add_argument('--data-dir',
+                        help='directory for generated data, temporary '
+                             'if not passed')
+    parser.add_argument('--output', help='file to write results to')
+    parser.add_argument('--compare', help='baseline results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed relative slowdown or memory growth')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    scales = [int(scale) for scale in args.scales.split(',')]
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, scales[0], args.data_dir)))
+        return 0
+
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.data_dir or temporary
+        os.makedirs(directory, exist_ok=True)
+        results = []
+        for scale in scales:
+            for name in args.graphs.split(','):
+                runs = [run_isolated(name, scale, directory)
+                        for _ in range(args.repeat)]
+                result = min(runs, key=lambda run: run['seconds'])
+                print('{graph:>12} {scale:>9} {seconds:>9.3f} s '
+                      '{peak_rss_kb:>9} KB {rows:>9} rows'.format(**result),
+                      file=sys.stderr)
+                results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION: ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
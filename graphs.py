@@ -1,8 +1,5 @@
 from .lib import Graph, operations
 from json import loads
-import datetime
-import calendar
-import math
 
 
 def divide(arg1, arg2):
@@ -19,9 +16,9 @@ def word_count_graph(input_stream: str, text_column: str, count_column: str,
     return graph0\
         .map(operations.FilterPunctuation(text_column)) \
         .map(operations.LowerCase(text_column)) \
+        .map(operations.Compact()) \
         .map(operations.Split(text_column)) \
-        .sort([text_column]) \
-        .reduce(operations.Count(count_column), [text_column]) \
+        .aggregate([operations.Count(count_column)], [text_column]) \
         .sort([count_column, text_column])
 
 
@@ -57,6 +54,7 @@ def inverted_index_graph(input_stream: str, doc_column: str, text_column: str,
     graph1 = graph0 \
         .map(operations.FilterPunctuation(text_column)) \
         .map(operations.LowerCase(text_column)) \
+        .map(operations.Compact()) \
         .map(operations.Split(text_column))
 
     graph2 = graph0 \
@@ -91,10 +89,8 @@ def inverted_index_graph(input_stream: str, doc_column: str, text_column: str,
 
     graph6 = graph5.join(operations.InnerJoiner(), graph3, keys=[text_column])\
         .map(operations.Product(['tf', 'idf'], result_column)) \
-        .sort([text_column, doc_column])\
         .map(operations.Project([doc_column, text_column, result_column])) \
-        .reduce(operations.TopN(column=result_column, n=3),
-                keys=[text_column]) \
+        .top_k(result_column, 3, keys=[text_column]) \
         .sort([doc_column, text_column])
 
     return graph6
@@ -120,15 +116,18 @@ def pmi_graph(input_stream: str, doc_column: str, text_column: str,
     graph0 = graph0 \
         .map(operations.FilterPunctuation(text_column)) \
         .map(operations.LowerCase(text_column)) \
+        .map(operations.Compact()) \
         .map(operations.Split(text_column)) \
-        .map(operations.Filter(condition=filter_length))\
+        .map(operations.Filter(condition=filter_length,
+                               columns=[text_column]))\
         .sort([text_column, doc_column])
 
     # Count number of current word in each doc and filter words
     graph1 = graph0\
         .reduce(operations.Count('words_in_doc'),
                 keys=[text_column, doc_column]) \
-        .map(operations.Filter(condition=filter_number))\
+        .map(operations.Filter(condition=filter_number,
+                               columns=['words_in_doc']))\
         .sort([doc_column, text_column])
 
     # Join to get only needed words
@@ -176,8 +175,7 @@ def pmi_graph(input_stream: str, doc_column: str, text_column: str,
         .map(operations.Idf('global_frequency', 'local_frequency',
                             result_column))\
         .map(operations.Project([text_column, result_column, 'doc_id']))\
-        .sort([doc_column])\
-        .reduce(operations.TopN(column=result_column, n=10), keys=[doc_column])
+        .top_k(result_column, 10, keys=[doc_column])
 
     return graph7
 
@@ -194,78 +192,43 @@ def yandex_maps_graph(input_stream_time: str, input_stream_length: str,
      on the weekday and hour
     """
 
-    def distance(row):
-        """Computes distance between objects based on lon and lat"""
-        radius = 6371.0  # km
-        lon1, lat1 = row[start_coord_column]
-        lon2, lat2 = row[end_coord_column]
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
-        a = (math.sin(dlat / 2) * math.sin(dlat / 2) +
-             math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-             math.sin(dlon / 2) * math.sin(dlon / 2))
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        d = radius * c
-        return d
-
-    def get_weekday(row):
-        """
-        Returns first three letters from weekday's name extracted from date
-        """
-        try:
-            day_number = datetime.datetime.\
-                strptime(row[enter_time_column], '%Y%m%dT%H%M%S.%f').weekday()
-        except ValueError:
-            day_number = datetime.datetime. \
-                strptime(row[enter_time_column], '%Y%m%dT%H%M%S').weekday()
-        return calendar.day_name[day_number][:3]
-
-    def parse_date(arg, with_milliseconds=True):
-        date_format = '%Y%m%dT%H%M%S.%f' if with_milliseconds \
-            else '%Y%m%dT%H%M%S'
-        return datetime.datetime.strptime(arg, date_format)
-
-    def get_hour(row):
-        """Returns hour extracted from given date"""
-        arg1 = row[enter_time_column]
-        try:
-            return parse_date(arg1).hour
-        except ValueError:
-            return parse_date(arg1, with_milliseconds=False).hour
-
-    def get_diff_in_hours(row):
-        arg1 = row[enter_time_column]
-        arg2 = row[leave_time_column]
-        try:
-            start_date = parse_date(arg1)
-        except ValueError:
-            start_date = parse_date(arg1, with_milliseconds=False)
-        try:
-            end_date = parse_date(arg2)
-        except ValueError:
-            end_date = parse_date(arg2, with_milliseconds=False)
-        return (end_date - start_date).total_seconds()/3600
-
-    graph0 = Graph().read_from_file(input_stream_length, loads) \
+    graph0 = Graph().read_from_file(input_stream_length, loads,
+                                    fields=[edge_id_column,
+                                            start_coord_column,
+                                            end_coord_column]) \
         if from_file \
         else Graph().read_from_iter(input_stream_length)
 
     graph0 = graph0 \
-        .map(operations.ApplyFunction(distance, 'distance'))
-
-    graph1 = Graph().read_from_file(input_stream_time, loads) \
+        .to_batches() \
+        .map(operations.Haversine(start_coord_column, end_coord_column,
+                                  'distance'))
+
+    graph1 = Graph().read_from_file(input_stream_time, loads,
+                                    fields=[enter_time_column,
+                                            leave_time_column,
+                                            edge_id_column]) \
         if from_file \
         else Graph().read_from_iter(input_stream_time)
 
+    def get_diff_in_hours(row):
+        # same as timedelta.total_seconds() / 3600
+        microseconds = row['leave_microseconds'] - row['enter_microseconds']
+        return microseconds / 1000000 / 3600
+
     graph1 = graph1 \
+        .map(operations.ParseTimestamp(enter_time_column,
+                                       'enter_microseconds',
+                                       weekday_result_column,
+                                       hour_result_column, memoize=100000))\
+        .map(operations.ParseTimestamp(leave_time_column,
+                                       'leave_microseconds',
+                                       memoize=100000))\
         .map(operations.ApplyFunction(get_diff_in_hours, 'hours'))\
-        .sort([edge_id_column])\
-        .join(operations.InnerJoiner(), graph0, keys=[edge_id_column])\
-        .map(operations.ApplyFunction(lambda row: float(row['distance'])
-                                      / row['hours'],
-                                      speed_result_column))\
-        .map(operations.ApplyFunction(get_weekday, weekday_result_column))\
-        .map(operations.ApplyFunction(get_hour, hour_result_column))\
+        .join(operations.InnerJoiner(), graph0, keys=[edge_id_column],
+              strategy='hash')\
+        .to_batches() \
+        .map(operations.Divide('distance', 'hours', speed_result_column))\
         .sort([weekday_result_column, hour_result_column]) \
         .map(operations.Project([weekday_result_column,
                                  hour_result_column, 'speed']))\
@@ -1,5 +1,4 @@
 import graphs
-from json import dump
 import os
 
 
@@ -12,19 +11,16 @@ def get_absolute_input_path(filename):
 graph = graphs.inverted_index_graph('file', doc_column='doc_id',
                                     text_column='text',
                                     result_column='tf_idf', from_file=True)
-result = graph.run(file=get_absolute_input_path('text_corpus.txt'))
-
-with open("tf_idf.txt", 'w') as j:
-    dump(result, j)
+graph.run_to_file("tf_idf.txt", format='json',
+                  file=get_absolute_input_path('text_corpus.txt'))
 
 
 # word count
 graph = graphs.word_count_graph('file', text_column='text',
                                 count_column='count',
                                 from_file=True)
-result = graph.run(file=get_absolute_input_path('text_corpus.txt'))
-with open("word_count.txt", 'w') as j:
-    dump(result, j)
+graph.run_to_file("word_count.txt", format='json',
+                  file=get_absolute_input_path('text_corpus.txt'))
 
 # Yandex maps
 graph = graphs.yandex_maps_graph(
@@ -38,19 +34,16 @@ graph = graphs.yandex_maps_graph(
     )
 
 
-result = graph.run(
+graph.run_to_file(
+        "yandex_maps.txt", format='json',
         travel_time=get_absolute_input_path('travel_times.txt'),
         edge_length='resource/road_graph_data.txt'
     )
 
-with open("yandex_maps.txt", 'w') as j:
-    dump(result, j)
-
 # pmi
 
 graph = graphs.pmi_graph('file', doc_column='doc_id', text_column='text',
                          result_column='pmi',
                          from_file=True)
-result = graph.run(file=get_absolute_input_path('text_corpus.txt'))
-with open("pmi.txt", 'w') as j:
-    dump(result, j)
+graph.run_to_file("pmi.txt", format='json',
+                  file=get_absolute_input_path('text_corpus.txt'))
@@ -0,0 +1,403 @@
+"""Column-oriented execution: operations exchange batches of rows stored
+column by column instead of one dict per row.
+
+Numeric columns are kept in NumPy arrays when NumPy is installed, other
+columns (and all columns without NumPy) are plain lists. 'ToBatches' and
+'ToRows' convert between row and batch streams, so mappers and reducers
+working with rows keep working inside batched part of a graph.
+"""
+from itertools import groupby
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .operations import Row, OperationResult, Operation, Ordering, Mapper, \
+    Reducer, Aggregator, Joiner, InnerJoiner, LeftJoiner, RightJoiner, \
+    OuterJoiner, Reduce, Sort, Join
+
+
+DEFAULT_BATCH_SIZE = 4096
+
+
+def _column(values: list):
+    """Store values as NumPy array when all of them are ints or floats"""
+    if numpy is None or not values:
+        return values
+    value_type = type(values[0])
+    if value_type not in (int, float) or \
+            any(type(value) is not value_type for value in values):
+        return values
+    try:
+        return numpy.array(values, dtype=numpy.int64 if value_type is int
+                           else numpy.float64)
+    except OverflowError:
+        return values
+
+
+def _to_list(column) -> list:
+    if hasattr(column, 'tolist'):
+        return column.tolist()
+    return column
+
+
+def _is_array(column) -> bool:
+    return hasattr(column, 'dtype')
+
+
+class Batch:
+    """Rows with the same columns stored column by column"""
+    def __init__(self, columns: Dict[str, Any], length: int):
+        """
+        :param columns: values of every column, lists or NumPy arrays
+        of equal length
+        :param length: number of rows
+        """
+        self.columns = columns
+        self.length = length
+
+    @classmethod
+    def from_rows(cls, rows: List[Row]) -> 'Batch':
+        """Batch of rows which have the same columns as the first one"""
+        if not rows:
+            return cls({}, 0)
+        return cls({key: _column([row[key] for row in rows])
+                    for key in rows[0]}, len(rows))
+
+    @staticmethod
+    def concat(batches: Sequence['Batch']) -> 'Batch':
+        """Single batch of batches with the same columns"""
+        if len(batches) == 1:
+            return batches[0]
+        columns = {}
+        for key in batches[0].keys():
+            parts = [batch[key] for batch in batches]
+            # NumPy would turn ints into floats when mixed with them
+            if all(_is_array(part) and part.dtype == parts[0].dtype
+                   for part in parts):
+                columns[key] = numpy.concatenate(parts)
+            else:
+                columns[key] = [value for part in parts
+                                for value in _to_list(part)]
+        return Batch(columns, sum(len(batch) for batch in batches))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, column: str):
+        return self.columns[column]
+
+    def __repr__(self):
+        return 'Batch({} rows, {})'.format(self.length, list(self.columns))
+
+    @property
+    def schema(self) -> Tuple[str, ...]:
+        return tuple(self.columns)
+
+    def keys(self):
+        return self.columns.keys()
+
+    def values(self):
+        return self.columns.values()
+
+    def select(self, columns: Sequence[str]) -> 'Batch':
+        """Batch with given columns only"""
+        return Batch({key: self.columns[key] for key in columns},
+                     self.length)
+
+    def with_column(self, column: str, values) -> 'Batch':
+        """Batch with added or replaced column"""
+        columns = dict(self.columns)
+        columns[column] = values
+        return Batch(columns, self.length)
+
+    def take(self, indices: Sequence[int]) -> 'Batch':
+        """Batch of rows with given indices in given order"""
+        columns = {}
+        for key, column in self.columns.items():
+            if _is_array(column):
+                columns[key] = column[numpy.asarray(indices,
+                                                    dtype=numpy.intp)]
+            else:
+                columns[key] = [column[index] for index in indices]
+        return Batch(columns, len(indices))
+
+    def slice(self, start: int, stop: int) -> 'Batch':
+        stop = min(stop, self.length)
+        return Batch({key: column[start:stop]
+                      for key, column in self.columns.items()},
+                     max(stop - start, 0))
+
+    def key_tuples(self, keys: Sequence[str]) -> List[tuple]:
+        """Values of key columns for every row"""
+        return list(zip(*(_to_list(self.columns[key]) for key in keys)))
+
+    def rows(self) -> Iterator[Row]:
+        names = list(self.columns)
+        for values in zip(*(_to_list(self.columns[key]) for key in names)):
+            yield dict(zip(names, values))
+
+
+def _split(batch: Batch, batch_size: int) -> Iterator[Batch]:
+    for start in range(0, len(batch), batch_size):
+        yield batch.slice(start, start + batch_size)
+
+
+def _batches_from_rows(rows: Iterable[Row],
+                       batch_size: int) -> Iterator[Batch]:
+    """Pack rows into batches; a batch ends when the set of columns changes
+    """
+    chunk = []
+    schema = None
+    for row in rows:
+        row_schema = tuple(row)
+        if chunk and (row_schema != schema or len(chunk) >= batch_size):
+            yield Batch.from_rows(chunk)
+            chunk = []
+        schema = row_schema
+        chunk.append(row)
+    if chunk:
+        yield Batch.from_rows(chunk)
+
+
+def _rows_from_batches(batches: Iterable[Batch]) -> OperationResult:
+    for batch in batches:
+        yield from batch.rows()
+
+
+class ToBatches(Operation):
+    """Pack stream of rows into batches"""
+    produces_batches = True
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        :param batch_size: maximal number of rows in a batch
+        """
+        self.batch_size = batch_size
+
+    def __call__(self, rows: Iterable[Row], *args) -> Iterator[Batch]:
+        yield from _batches_from_rows(rows, self.batch_size)
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return input_orderings[0]
+
+
+class ToRows(Operation):
+    """Unpack stream of batches into rows"""
+    def __call__(self, batches: Iterable[Batch], *args) -> OperationResult:
+        yield from _rows_from_batches(batches)
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return input_orderings[0]
+
+
+class BatchMap(Operation):
+    """Map over batches. Mappers having 'map_batch(batch) -> Batch' process
+    whole batches, others are applied to rows of every batch"""
+    produces_batches = True
+
+    def __init__(self, mapper: Mapper):
+        """
+        :param mapper: mapper to use
+        """
+        self.mapper = mapper
+
+    def __call__(self, batches: Iterable[Batch], *args) -> Iterator[Batch]:
+        map_batch = getattr(self.mapper, 'map_batch', None)
+        for batch in batches:
+            if map_batch is not None:
+                batch = map_batch(batch)
+                if len(batch):
+                    yield batch
+                continue
+            rows = [new_row for row in batch.rows()
+                    for new_row in self.mapper.apply(row)]
+            yield from _batches_from_rows(rows, max(len(rows), 1))
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return self.mapper.ordering(input_orderings[0])
+
+
+class BatchSort(Operation):
+    """Stable in-memory sort of batches"""
+    produces_batches = True
+
+    def __init__(self, keys: Sequence[str],
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 input_ordering: Ordering = ()):
+        """
+        :param keys: sorting keys
+        :param batch_size: maximal number of rows in output batches
+        :param input_ordering: ordering guaranteed by the input; sorting is
+        skipped when keys are its prefix
+        """
+        self.keys = keys
+        self.batch_size = batch_size
+        self._input_ordering = tuple(input_ordering)
+
+    def is_redundant(self) -> bool:
+        return self._input_ordering[:len(self.keys)] == tuple(self.keys)
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return Sort(self.keys).ordering(*input_orderings)
+
+    def with_input_orderings(self, *input_orderings: Ordering) \
+            -> 'BatchSort':
+        return BatchSort(self.keys, batch_size=self.batch_size,
+                         input_ordering=input_orderings[0])
+
+    def _order(self, batch: Batch) -> Sequence[int]:
+        columns = [batch[key] for key in self.keys]
+        if all(_is_array(column) for column in columns):
+            # lexsort is stable and treats the last key as the primary one
+            return numpy.lexsort(columns[::-1])
+        key_tuples = batch.key_tuples(self.keys)
+        return sorted(range(len(batch)), key=key_tuples.__getitem__)
+
+    def __call__(self, batches: Iterable[Batch], *args) -> Iterator[Batch]:
+        if self.is_redundant():
+            yield from batches
+            return
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return
+        if len({batch.schema for batch in batches}) > 1:
+            rows = Sort(self.keys)(_rows_from_batches(batches))
+            yield from _batches_from_rows(rows, self.batch_size)
+            return
+        batch = Batch.concat(batches)
+        yield from _split(batch.take(self._order(batch)), self.batch_size)
+
+
+class BatchReduce(Operation):
+    """Reduce over batches sorted by keys. Aggregators consume whole runs of
+    equal keys with 'update_batch'; other reducers get rows of every group"""
+    produces_batches = True
+
+    def __init__(self, reducer: Reducer, keys: Sequence[str],
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        :param reducer: reducer to use
+        :param keys: keys for grouping
+        :param batch_size: maximal number of rows in output batches
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self.batch_size = batch_size
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return Reduce(self.reducer, self.keys).ordering(*input_orderings)
+
+    def _aggregate(self, batches: Iterable[Batch]) -> Iterator[Row]:
+        aggregator = self.reducer  # type: Aggregator
+        current_key, state = None, None
+        for batch in batches:
+            key_tuples = batch.key_tuples(self.keys)
+            start = 0
+            for key, run in groupby(key_tuples):
+                stop = start + sum(1 for _ in run)
+                if state is not None and key != current_key:
+                    yield self._result_row(current_key, state)
+                    state = None
+                if state is None:
+                    current_key, state = key, aggregator.initial()
+                state = aggregator.update_batch(state,
+                                                batch.slice(start, stop))
+                start = stop
+        if state is not None:
+            yield self._result_row(current_key, state)
+
+    def _result_row(self, key: tuple, state: Any) -> Row:
+        new_row = dict(zip(self.keys, key))
+        new_row[self.reducer.column] = self.reducer.result(state)
+        return new_row
+
+    def __call__(self, batches: Iterable[Batch], *args) -> Iterator[Batch]:
+        if isinstance(self.reducer, Aggregator):
+            rows = self._aggregate(batches)
+        else:
+            rows = Reduce(self.reducer, self.keys)(
+                _rows_from_batches(batches))
+        yield from _batches_from_rows(rows, self.batch_size)
+
+
+class BatchJoin(Operation):
+    """Hash join of batches: right input is kept in memory and looked up by
+    keys of left batches. Merged columns are gathered column by column.
+    Joiners other than inner, left, right and outer are applied to rows
+    by sort-merge join"""
+    produces_batches = True
+
+    def __init__(self, joiner: Joiner, keys: Sequence[str],
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        :param joiner: join strategy to use
+        :param keys: keys for joining
+        :param batch_size: maximal number of rows in output batches
+        """
+        self.joiner = joiner
+        self.keys = keys
+        self.batch_size = batch_size
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return ()
+
+    def _merge(self, left: Batch, left_indices: List[int],
+               right: Batch, right_indices: List[int]) -> Batch:
+        left, right = left.take(left_indices), right.take(right_indices)
+        columns = {}
+        for column, side, source in self.joiner.merge_layout(
+                self.keys, left.schema, right.schema):
+            columns[column] = (left, right)[side][source]
+        return Batch(columns, len(left_indices))
+
+    def __call__(self, batches: Iterable[Batch], *args) -> Iterator[Batch]:
+        joiner_type = type(self.joiner)
+        if joiner_type not in (InnerJoiner, LeftJoiner, RightJoiner,
+                               OuterJoiner):
+            rows = Join(self.joiner, self.keys, strategy='sort')(
+                _rows_from_batches(batches), _rows_from_batches(args[0]))
+            yield from _batches_from_rows(rows, self.batch_size)
+            return
+        keep_left = joiner_type in (LeftJoiner, OuterJoiner)
+        keep_right = joiner_type in (RightJoiner, OuterJoiner)
+
+        right_batches = [batch for batch in args[0] if len(batch)]
+        # key -> positions of right rows as (batch number, row number)
+        table = {}
+        for number, batch in enumerate(right_batches):
+            for index, key in enumerate(batch.key_tuples(self.keys)):
+                table.setdefault(key, []).append((number, index))
+
+        matched = set()
+        for batch in batches:
+            unmatched = []
+            pairs = [[] for _ in right_batches]
+            for index, key in enumerate(batch.key_tuples(self.keys)):
+                positions = table.get(key)
+                if positions is None:
+                    unmatched.append(index)
+                    continue
+                matched.add(key)
+                for number, right_index in positions:
+                    pairs[number].append((index, right_index))
+            for number, batch_pairs in enumerate(pairs):
+                if batch_pairs:
+                    left_indices, right_indices = zip(*batch_pairs)
+                    yield from _split(
+                        self._merge(batch, list(left_indices),
+                                    right_batches[number],
+                                    list(right_indices)),
+                        self.batch_size)
+            if keep_left and unmatched:
+                yield batch.take(unmatched)
+
+        if keep_right:
+            for batch in right_batches:
+                unmatched = [index for index, key
+                             in enumerate(batch.key_tuples(self.keys))
+                             if key not in matched]
+                if unmatched:
+                    yield batch.take(unmatched)
@@ -0,0 +1,283 @@
+"""Caching of results of graph nodes: within a single run for nodes read by
+several consumers and on disk between runs"""
+import hashlib
+import os
+import pickle
+import tempfile
+from types import FunctionType, CodeType, BuiltinFunctionType
+from typing import Callable, Dict, Iterable, List, Optional
+
+from .batch import Batch
+from .operations import Row, OperationResult, Map, FusedMap, \
+    _estimate_size, _read_spilled
+from .parallel import ParallelMap
+
+
+def _copied(row: Row) -> Row:
+    """Copy of row for a consumer which may change it; batches are never
+    changed in place"""
+    return row if isinstance(row, Batch) else row.copy()
+
+
+class SharedResult:
+    """Output of a node materialized once for all of its consumers.
+    Rows are kept in memory until they exceed memory limit, then all of them
+    go to a temporary file. Data is dropped when the last consumer finishes
+    reading. Mappers change rows in place, so every consumer gets own copies
+    of rows kept in memory, except the one reading when the others are done
+    """
+    def __init__(self, compute: Callable[[], Iterable[Row]], consumers: int,
+                 memory_limit: int = None):
+        """
+        :param compute: function returning rows of the node
+        :param consumers: number of readers of the result
+        :param memory_limit: approximate number of bytes of rows kept in
+        memory; None means no limit
+        """
+        self._compute = compute
+        self._consumers = consumers
+        self._memory_limit = memory_limit
+        self._materialized = False
+        self._rows = None  # type: List[Row]
+        self._path = None  # type: str
+
+    @property
+    def is_spilled(self) -> bool:
+        return self._path is not None
+
+    def _materialize(self) -> None:
+        rows = []
+        rows_size = 0
+        spill_file = None
+        for row in self._compute():
+            if spill_file is not None:
+                pickle.dump(row, spill_file, pickle.HIGHEST_PROTOCOL)
+                continue
+            rows.append(row)
+            if self._memory_limit is None:
+                continue
+            rows_size += _estimate_size(row)
+            if rows_size > self._memory_limit:
+                descriptor, self._path = tempfile.mkstemp(suffix='.rows')
+                spill_file = os.fdopen(descriptor, 'wb')
+                for spilled_row in rows:
+                    pickle.dump(spilled_row, spill_file,
+                                pickle.HIGHEST_PROTOCOL)
+                rows = None
+        if spill_file is not None:
+            spill_file.close()
+        self._rows = rows
+        self._materialized = True
+
+    def read(self) -> OperationResult:
+        """Rows of the node for one consumer"""
+        try:
+            if not self._materialized:
+                self._materialize()
+            if self._path is None:
+                for row in self._rows:
+                    yield row if self._consumers == 1 else _copied(row)
+            else:
+                yield from _read_spilled(open(self._path, 'rb'))
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        self._consumers -= 1
+        if self._consumers <= 0:
+            self.evict()
+
+    def evict(self) -> None:
+        self._rows = None
+        if self._path is not None:
+            os.remove(self._path)
+            self._path = None
+
+
+class MaterializationCache:
+    """Shares outputs of nodes between their consumers during a single run
+    and serves outputs of nodes from the result store when it is passed"""
+    def __init__(self, consumers: Dict[int, int], memory_limit: int = None,
+                 store: 'ResultStore' = None,
+                 fingerprints: Dict[int, str] = None):
+        """
+        :param consumers: number of consumers of every node by id of node
+        :param memory_limit: memory limit for every shared result
+        :param store: persistent store of node outputs
+        :param fingerprints: keys of stored nodes by id of node
+        """
+        self._consumers = consumers
+        self._memory_limit = memory_limit
+        self._store = store
+        self._fingerprints = fingerprints or {}
+        self._results = {}  # type: Dict[int, SharedResult]
+
+    def _stored(self, node, compute: Callable[[], Iterable[Row]]) \
+            -> Callable[[], Iterable[Row]]:
+        key = self._fingerprints.get(id(node))
+        if self._store is None or key is None:
+            return compute
+
+        def load_or_compute():
+            stored = self._store.get(key)
+            if stored is not None:
+                return stored
+            return self._store.put(key, compute())
+        return load_or_compute
+
+    def rows(self, node, compute: Callable[[], Iterable[Row]]) \
+            -> Iterable[Row]:
+        """Rows of node for one of its consumers"""
+        compute = self._stored(node, compute)
+        consumers = self._consumers.get(id(node), 0)
+        if consumers <= 1:
+            return compute()
+        shared = self._results.get(id(node))
+        if shared is None:
+            shared = self._results[id(node)] = \
+                SharedResult(compute, consumers, self._memory_limit)
+        return shared.read()
+
+    def close(self) -> None:
+        """Drop results which weren't read by all of their consumers"""
+        for shared in self._results.values():
+            shared.evict()
+        self._results.clear()
+
+
+def fingerprint(obj, depth: int = 0) -> str:
+    """Description of the object which stays the same between runs as long
+    as its parameters and code don't change. Globals referenced by functions
+    are not taken into account"""
+    if depth > 20:
+        raise ValueError('too deep object to fingerprint')
+    depth += 1
+    if obj is None or isinstance(obj, (str, bytes, int, float, bool)):
+        return repr(obj)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        items = [fingerprint(item, depth) for item in obj]
+        if isinstance(obj, (set, frozenset)):
+            items.sort()
+        return '{}[{}]'.format(type(obj).__name__, ','.join(items))
+    if isinstance(obj, dict):
+        return 'dict{{{}}}'.format(','.join(sorted(
+            '{}:{}'.format(fingerprint(key, depth), fingerprint(value, depth))
+            for key, value in obj.items())))
+    if isinstance(obj, CodeType):
+        return 'code({},{},{})'.format(obj.co_code.hex(),
+                                       fingerprint(obj.co_consts, depth),
+                                       fingerprint(obj.co_names, depth))
+    if isinstance(obj, FunctionType):
+        closure = [cell.cell_contents for cell in obj.__closure__ or ()]
+        return 'function({}.{},{},{},{})'.format(
+            obj.__module__, obj.__qualname__,
+            fingerprint(obj.__code__, depth),
+            fingerprint(obj.__defaults__, depth),
+            fingerprint(closure, depth))
+    if isinstance(obj, (BuiltinFunctionType, type)):
+        return '{}.{}'.format(obj.__module__, obj.__qualname__)
+    if hasattr(obj, '__dict__'):
+        return '{}.{}{}'.format(type(obj).__module__, type(obj).__qualname__,
+                                fingerprint(vars(obj), depth))
+    raise ValueError('cannot fingerprint {!r}'.format(obj))
+
+
+def _is_worth_storing(node) -> bool:
+    """Maps are cheap to recompute from their stored parents"""
+    return node.operation is not None and \
+        not isinstance(node.operation, (Map, FusedMap, ParallelMap))
+
+
+def node_fingerprints(graph, kwargs) -> Dict[int, str]:
+    """Keys in result store for the graph and its nodes worth storing, by id
+    of node. Only nodes depending solely on files get keys; files are
+    identified by path, size and modification time"""
+    memo = {}
+    keys = {}
+
+    def visit(node) -> Optional[str]:
+        if id(node) in memo:
+            return memo[id(node)]
+        parents = [visit(parent) for parent in node.parents]
+        try:
+            if node.operation is None:
+                if node.reader is None:
+                    result = None
+                else:
+                    path = os.path.abspath(kwargs[node.data_source])
+                    stat = os.stat(path)
+                    result = fingerprint(('file', path, stat.st_size,
+                                          stat.st_mtime_ns, node.reader))
+            elif None in parents:
+                result = None
+            else:
+                result = fingerprint((fingerprint(node.operation), parents))
+        except ValueError:
+            result = None
+        if result is not None:
+            result = hashlib.sha256(result.encode()).hexdigest()
+            if node is graph or _is_worth_storing(node):
+                keys[id(node)] = result
+        memo[id(node)] = result
+        return result
+
+    visit(graph)
+    return keys
+
+
+class ResultStore:
+    """Outputs of nodes stored in directory between runs. When total size
+    of stored outputs exceeds size limit, least recently used ones are
+    removed"""
+    suffix = '.rows'
+
+    def __init__(self, directory: str, size_limit: int = 1 << 30):
+        """
+        :param directory: directory to keep outputs in
+        :param size_limit: maximal total size of stored outputs in bytes
+        """
+        self.directory = directory
+        self.size_limit = size_limit
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key: str) -> Optional[OperationResult]:
+        """Stored rows or None if there are no such rows"""
+        try:
+            stored_file = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(self._path(key))
+        return _read_spilled(stored_file)
+
+    def put(self, key: str, rows: Iterable[Row]) -> OperationResult:
+        """Pass rows through storing them; rows are stored only if all of
+        them were read"""
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory)
+        committed = False
+        try:
+            with os.fdopen(descriptor, 'wb') as stored_file:
+                for row in rows:
+                    pickle.dump(row, stored_file, pickle.HIGHEST_PROTOCOL)
+                    yield row
+            os.replace(temporary_path, self._path(key))
+            committed = True
+            self._evict()
+        finally:
+            if not committed and os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.size_limit:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total_size -= size
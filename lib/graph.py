@@ -1,20 +1,88 @@
-from typing import Sequence, Callable, List
-import uuid
-from itertools import tee
+from typing import Sequence, Callable, Iterable, Iterator, List
+import json
 
-from .operations import Row, Mapper, Reducer, Joiner, Map, \
-    Reduce, Sort, Join, CountAll, Read, ReadFromFile
+from . import optimizer
+from .batch import ToBatches, ToRows, BatchMap, BatchSort, BatchReduce, \
+    BatchJoin, DEFAULT_BATCH_SIZE
+from .cache import MaterializationCache, ResultStore, node_fingerprints
+from .profiling import Profiler
+from .parallel import ParallelMap, ParallelReduce, ParallelAggregate, \
+    ParallelReadFromFile
+from .operations import Row, Ordering, Operation, Mapper, Reducer, \
+    Joiner, Aggregator, Map, Reduce, HashAggregate, Sort, Join, CountAll, \
+    TopK, JoinStats, \
+    Read, ReadFromFile, to_dict
+
+
+# keyword parameters of 'run', 'run_iter' and 'run_to_file' which can't be
+# names of data sources passed along with them
+RUN_PARAMETERS = ('optimize', 'cache_dir', 'cache_size', 'profile',
+                  'memory_limit', 'path', 'format')
+
+
+def _check_source_name(name: str) -> None:
+    if name in RUN_PARAMETERS:
+        raise ValueError('data source can\'t be named {!r}: it is a '
+                         'parameter of Graph.run'.format(name))
 
 
 class Graph:
     """Computational graph implementation"""
     def __init__(self, parents=None, data_source=None, parser=None,
-                 operation=None):
+                 operation=None, reader=None):
         self.__data_source = data_source
         self.__parents = parents if parents is not None else []
         self.__parser = parser
+        self.__reader = reader
         self.__operation = operation
-        self.__id = str(uuid.uuid1())
+        self.__ordering = () if operation is None else operation.ordering(
+            *(parent.ordering for parent in self.__parents))
+
+    @property
+    def ordering(self) -> Ordering:
+        """Columns by which output rows are known to be sorted"""
+        return self.__ordering
+
+    @property
+    def is_batched(self) -> bool:
+        """Whether the graph outputs batches instead of rows"""
+        return self.__operation is not None and \
+            self.__operation.produces_batches
+
+    @property
+    def parents(self) -> List['Graph']:
+        return self.__parents
+
+    @property
+    def operation(self) -> Operation:
+        return self.__operation
+
+    @property
+    def data_source(self) -> str:
+        return self.__data_source
+
+    @property
+    def parser(self) -> Callable[[str], Row]:
+        return self.__parser
+
+    @property
+    def reader(self) -> Callable[[str], Iterable[Row]]:
+        """Reader of rows from file for nodes reading files"""
+        return self.__reader
+
+    def with_parents(self, parents: List['Graph'],
+                     operation: Operation = None) -> 'Graph':
+        """Construct new graph applying the same operation to other parents
+        :param parents: new parents
+        :param operation: operation to apply instead of the current one
+        """
+        if operation is None:
+            operation = self.__operation
+        operation = operation.with_input_orderings(
+            *(parent.ordering for parent in parents))
+        return Graph(data_source=self.__data_source, parents=parents,
+                     parser=self.__parser, operation=operation,
+                     reader=self.__reader)
 
     def read_from_iter(self, name: str) -> 'Graph':
         """
@@ -23,40 +91,122 @@ class Graph:
         from 'kwargs' passed to 'run' method) into graph data-flow
         :param name: name of kwarg to use as data source
         """
+        _check_source_name(name)
         self.__data_source = name
         return Graph(data_source=self.__data_source,
                      parents=[self], parser=self.__parser)
 
     def read_from_file(self, filename: str,
-                       parser: Callable[[str], Row]) -> 'Graph':
+                       parser: Callable[[str], Row],
+                       fields: Sequence[str] = None, workers: int = None,
+                       ordered: bool = True) -> 'Graph':
         """Construct new graph extended with operation
         for reading rows from file
         :param filename: filename to read from
         :param parser: parser from string to Row
+        :param fields: columns used by the graph; others are dropped
+        right after parsing
+        :param workers: number of processes parsing parts of the file
+        in parallel; sequential reading if not passed
+        :param ordered: keep order of rows of the file when reading
+        in parallel
         """
+        _check_source_name(filename)
         self.__data_source = filename
         self.__parser = parser
+        reader = ReadFromFile(parser, fields=fields) if workers is None \
+            else ParallelReadFromFile(parser, workers, ordered=ordered,
+                                      fields=fields)
         return Graph(data_source=self.__data_source,
-                     parents=[self], parser=self.__parser)
+                     parents=[self], parser=self.__parser, reader=reader)
+
+    def to_batches(self, batch_size: int = DEFAULT_BATCH_SIZE) -> 'Graph':
+        """Construct new graph whose rows are packed into column-oriented
+        batches; map, sort, reduce and join of the result work on batches
+        :param batch_size: maximal number of rows in a batch
+        """
+        if self.is_batched:
+            return self
+        return Graph(data_source=self.__data_source,
+                     parents=[self], parser=self.__parser,
+                     operation=ToBatches(batch_size))
+
+    def to_rows(self) -> 'Graph':
+        """Construct new graph unpacking batches back into rows"""
+        if not self.is_batched:
+            return self
+        return Graph(data_source=self.__data_source,
+                     parents=[self], parser=self.__parser,
+                     operation=ToRows())
 
-    def map(self, mapper: Mapper) -> 'Graph':
+    def map(self, mapper: Mapper, workers: int = None, ordered: bool = True,
+            chunk_size: int = 1000) -> 'Graph':
         """Construct new graph extended with map operation
         with particular mapper
         :param mapper: mapper to use
+        :param workers: number of processes to map rows in parallel;
+        serial map if not passed
+        :param ordered: keep order of rows when mapping in parallel
+        :param chunk_size: number of rows sent to a worker at once
         """
+        if workers is not None:
+            return Graph(data_source=self.__data_source,
+                         parents=[self.to_rows()], parser=self.__parser,
+                         operation=ParallelMap(mapper, workers,
+                                               ordered=ordered,
+                                               chunk_size=chunk_size))
+        operation = BatchMap(mapper) if self.is_batched else Map(mapper)
         return Graph(data_source=self.__data_source,
                      parents=[self], parser=self.__parser,
-                     operation=Map(mapper))
+                     operation=operation)
 
-    def reduce(self, reducer: Reducer, keys: Sequence[str]) -> 'Graph':
+    def reduce(self, reducer: Reducer, keys: Sequence[str],
+               workers: int = None) -> 'Graph':
         """Construct new graph extended with reduce operation
         with particular reducer
         :param reducer: reducer to use
         :param keys: keys for grouping
+        :param workers: number of processes to reduce hash partitions of
+        rows in parallel; such reduce doesn't need sorted input
         """
+        if workers is not None:
+            return Graph(data_source=self.__data_source,
+                         parents=[self.to_rows()], parser=self.__parser,
+                         operation=ParallelReduce(reducer, keys=keys,
+                                                  workers=workers))
+        operation = BatchReduce(reducer, keys=keys) if self.is_batched \
+            else Reduce(reducer, keys=keys)
         return Graph(data_source=self.__data_source,
                      parents=[self], parser=self.__parser,
-                     operation=Reduce(reducer, keys=keys))
+                     operation=operation)
+
+    def aggregate(self, aggregators: Sequence[Aggregator],
+                  keys: Sequence[str], workers: int = None) -> 'Graph':
+        """Construct new graph extended with hash aggregation which
+        computes aggregators for every group without sorting rows
+        :param aggregators: aggregators to use, each yields own column
+        :param keys: keys for grouping
+        :param workers: number of processes combining partial results
+        in parallel
+        """
+        operation = HashAggregate(aggregators, keys=keys) \
+            if workers is None else \
+            ParallelAggregate(aggregators, keys=keys, workers=workers)
+        return Graph(data_source=self.__data_source,
+                     parents=[self.to_rows()], parser=self.__parser,
+                     operation=operation)
+
+    def top_k(self, column: str, n: int,
+              keys: Sequence[str] = None) -> 'Graph':
+        """Construct new graph keeping n rows with the largest values of
+        column for every key; doesn't need sorted input
+        :param column: column to rank rows by
+        :param n: number of rows to keep for every key
+        :param keys: keys for grouping; top of all rows if not passed
+        """
+        return Graph(data_source=self.__data_source,
+                     parents=[self.to_rows()], parser=self.__parser,
+                     operation=TopK(column, n, keys=keys or ()))
 
     def count(self, counter: Reducer, keys: Sequence[str]) -> 'Graph':
         """Construct new graph extended with count operation
@@ -65,51 +215,175 @@ class Graph:
         :param keys: keys for grouping
         """
         return Graph(data_source=self.__data_source,
-                     parents=[self], parser=self.__parser,
+                     parents=[self.to_rows()], parser=self.__parser,
                      operation=CountAll(counter, keys=keys))
 
-    def sort(self, keys: Sequence[str]) -> 'Graph':
+    def sort(self, keys: Sequence[str], memory_limit: int = None,
+             descending: Sequence[str] = ()) -> 'Graph':
         """Construct new graph extended with sort operation
         :param keys: sorting keys (typical is tuple of strings)
+        :param memory_limit: approximate memory budget in bytes; rows above
+        it are sorted externally through temporary files;
+        batches are always sorted in memory
+        :param descending: keys to sort in descending order
         """
+        if descending:
+            return Graph(data_source=self.__data_source,
+                         parents=[self.to_rows()], parser=self.__parser,
+                         operation=Sort(keys=keys, memory_limit=memory_limit,
+                                        input_ordering=self.ordering,
+                                        descending=descending))
+        if self.is_batched:
+            return Graph(data_source=self.__data_source,
+                         parents=[self], parser=self.__parser,
+                         operation=BatchSort(keys=keys,
+                                             input_ordering=self.ordering))
         return Graph(data_source=self.__data_source,
                      parents=[self], parser=self.__parser,
-                     operation=Sort(keys=keys))
+                     operation=Sort(keys=keys, memory_limit=memory_limit,
+                                    input_ordering=self.ordering))
 
     def join(self, joiner: Joiner, join_graph: 'Graph',
-             keys: Sequence[str]) -> 'Graph':
+             keys: Sequence[str], strategy: str = 'auto',
+             size_hint: int = None, stats: JoinStats = None) -> 'Graph':
         """Construct new graph extended with join operation with another graph
         :param joiner: join strategy to use
         :param join_graph: other graph to join with
         :param keys: keys for grouping
+        :param strategy: 'sort', 'hash' or 'auto' (sort-merge join unless
+        size_hint is passed, then hash join when one of the inputs is
+        small); hash join doesn't sort its output by keys
+        :param size_hint: expected number of rows in join_graph
+        :param stats: statistics to record sizes of joined groups into;
+        they are collected by sort-merge join, which is used whatever the
+        strategy, and batched graphs are joined by rows
         """
+        if strategy not in Join.strategies:
+            raise ValueError('unknown join strategy {!r}'.format(strategy))
+        if self.is_batched and stats is None:
+            return Graph(data_source=self.__data_source,
+                         parents=[self, join_graph.to_batches()],
+                         parser=self.__parser,
+                         operation=BatchJoin(joiner, keys=keys))
+        graph, join_graph = self.to_rows(), join_graph.to_rows()
         return Graph(data_source=self.__data_source,
-                     parents=[self, join_graph], parser=self.__parser,
-                     operation=Join(joiner, keys=keys))
-
-    def run_recursively(self, kwargs, cache):
-        if len(self.__parents) == 2:
-            parent1 = self.__parents[0].run_recursively(kwargs, cache)
-            parent2 = self.__parents[1].run_recursively(kwargs, cache)
-            return self.__operation(parent1, parent2)
-
-        elif self.__operation is not None:
-            if self.__id in cache:
-                print("It's a cache")
-                current, copy = tee(cache[self.__id])
-                return copy
-            else:
-                current, calculate = \
-                    tee(self.__operation(
-                        self.__parents[0].run_recursively(kwargs, cache)))
-                cache[self.__id] = calculate
-                return current
-        else:
-            if self.__parser is not None:
-                return ReadFromFile(self.__parser)(kwargs[self.__data_source])
-            return Read()(kwargs[self.__data_source])
-
-    def run(self, **kwargs) -> List[Row]:
-        """Single method to start execution; data sources passed as kwargs"""
-        cache = {}
-        return list(self.run_recursively(kwargs, cache))
+                     parents=[graph, join_graph], parser=self.__parser,
+                     operation=Join(joiner, keys=keys, strategy=strategy,
+                                    size_hint=size_hint,
+                                    input_orderings=(graph.ordering,
+                                                     join_graph.ordering),
+                                    stats=stats))
+
+    def _compute(self, kwargs, cache: MaterializationCache,
+                 profiler: Profiler = None):
+        if self.__operation is not None:
+            inputs = [parent.run_recursively(kwargs, cache, profiler)
+                      for parent in self.__parents]
+            if profiler is not None:
+                inputs = [profiler.inputs(self, rows) for rows in inputs]
+            return self.__operation(*inputs)
+        if self.__reader is not None:
+            return self.__reader(kwargs[self.__data_source])
+        return Read()(kwargs[self.__data_source])
+
+    def run_recursively(self, kwargs, cache: MaterializationCache,
+                        profiler: Profiler = None):
+        def compute():
+            return self._compute(kwargs, cache, profiler)
+        if profiler is not None:
+            compute = profiler.outputs(self, compute)
+        return cache.rows(self, compute)
+
+    def explain(self) -> None:
+        """Print execution plan of the graph before and after optimization"""
+        print('Plan:')
+        print(optimizer.format_plan(self))
+        print('Optimized plan:')
+        print(optimizer.format_plan(optimizer.optimize(self)))
+
+    def run_iter(self, optimize: bool = True, cache_dir: str = None,
+                 cache_size: int = 1 << 30, profile: bool = False,
+                 memory_limit: int = None, **kwargs) -> Iterator[Row]:
+        """Lazy version of 'run': rows are computed as they are consumed
+        :param optimize: rewrite the graph with 'optimizer' rules before
+        execution
+        :param cache_dir: directory to store outputs of nodes between runs;
+        nodes which depend only on unchanged files and operations are read
+        from it instead of being computed
+        :param cache_size: size limit of cache_dir in bytes
+        :param profile: print rows and time of every node after execution
+        :param memory_limit: approximate number of bytes of rows kept in
+        memory by the whole run; it is split between sorts, reduces, joins
+        and results shared by several nodes, which spill rows above their
+        shares to temporary files. Not bounded by it: states of 'aggregate'
+        (one per key), 'top_k' (n rows per key), partitions of parallel
+        reduce and aggregate, and batched sorts and joins
+        """
+        graph = optimizer.optimize(self) if optimize else self
+        shared_limit = None
+        if memory_limit is not None:
+            graph, shared_limit = optimizer.limit_memory(graph, memory_limit)
+        store, fingerprints = None, None
+        if cache_dir is not None:
+            store = ResultStore(cache_dir, size_limit=cache_size)
+            fingerprints = node_fingerprints(graph, kwargs)
+        cache = MaterializationCache(optimizer.count_consumers(graph),
+                                     memory_limit=shared_limit,
+                                     store=store, fingerprints=fingerprints)
+        profiler = Profiler() if profile else None
+        try:
+            result = graph.run_recursively(kwargs, cache, profiler)
+            if graph.is_batched:
+                result = ToRows()(result)
+            for row in result:
+                yield to_dict(row)
+        finally:
+            cache.close()
+        if profiler is not None:
+            print('Profile:')
+            print(profiler.report(graph))
+
+    def run(self, optimize: bool = True, cache_dir: str = None,
+            cache_size: int = 1 << 30, profile: bool = False,
+            memory_limit: int = None, **kwargs) -> List[Row]:
+        """Single method to start execution; data sources passed as kwargs,
+        so their names can't be the same as parameters ('RUN_PARAMETERS')
+        :param optimize: rewrite the graph with 'optimizer' rules before
+        execution
+        :param cache_dir: directory to store outputs of nodes between runs;
+        nodes which depend only on unchanged files and operations are read
+        from it instead of being computed
+        :param cache_size: size limit of cache_dir in bytes
+        :param profile: print rows and time of every node after execution
+        :param memory_limit: approximate number of bytes of rows kept in
+        memory by the whole run, see 'run_iter'
+        """
+        return list(self.run_iter(optimize=optimize, cache_dir=cache_dir,
+                                  cache_size=cache_size, profile=profile,
+                                  memory_limit=memory_limit, **kwargs))
+
+    def run_to_file(self, path: str, format: str = 'jsonl',
+                    **kwargs) -> int:
+        """Execute graph writing rows into file as they are produced
+        :param path: file to write to
+        :param format: 'jsonl' for row per line, 'json' for a JSON list
+        :param kwargs: arguments of 'run'
+        :return: number of rows written
+        """
+        if format not in ('jsonl', 'json'):
+            raise ValueError('unknown format {!r}'.format(format))
+        count = 0
+        with open(path, 'w') as f:
+            if format == 'json':
+                f.write('[')
+            for row in self.run_iter(**kwargs):
+                if format == 'jsonl':
+                    f.write(json.dumps(row))
+                    f.write('\n')
+                else:
+                    f.write(', ' if count else '')
+                    f.write(json.dumps(row))
+                count += 1
+            if format == 'json':
+                f.write(']')
+        return count
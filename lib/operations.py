@@ -1,19 +1,254 @@
 from abc import abstractmethod, ABC
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+import copy
+import os
 from types import FunctionType
-from typing import NewType, Dict, Any, Generator, Iterable, Tuple, Sequence
+from typing import NewType, Dict, Any, Generator, Iterable, Tuple, \
+    Sequence, List, Optional
+import calendar
+import datetime
 import string
-from itertools import groupby, chain, tee
+from functools import lru_cache
+from itertools import groupby, chain, tee, islice, takewhile
+from operator import itemgetter
+import heapq
+import json
 import math
+import pickle
+import sys
+import tempfile
+import weakref
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 Row = NewType('Row', Dict[str, Any])
 OperationResult = NewType('OperationResult', Generator[Row, None, None])
+# Columns by which rows are known to be sorted (ascending);
+# empty tuple means no ordering is guaranteed
+Ordering = Tuple[str, ...]
+
+
+class Schema:
+    """Column names shared by compact rows. There is a single instance for
+    every tuple of columns, also after unpickling"""
+    _instances = {}  # type: Dict[Tuple[str, ...], Schema]
+
+    def __new__(cls, columns: Sequence[str]):
+        columns = tuple(columns)
+        schema = cls._instances.get(columns)
+        if schema is None:
+            schema = super().__new__(cls)
+            schema.columns = columns
+            schema.index = {column: index
+                            for index, column in enumerate(columns)}
+            schema._extended = {}
+            cls._instances[columns] = schema
+        return schema
+
+    def __reduce__(self):
+        return Schema, (self.columns,)
+
+    def __repr__(self):
+        return 'Schema({!r})'.format(self.columns)
+
+    def extended(self, column: str) -> 'Schema':
+        """Schema with column added to the end"""
+        schema = self._extended.get(column)
+        if schema is None:
+            schema = self._extended[column] = Schema(self.columns + (column,))
+        return schema
+
+
+class CompactRow(MutableMapping):
+    """Row storing only a tuple of values and a reference to shared schema
+    instead of a dict of its own. Behaves like a dict of the same columns
+    in the same order; graphs return plain dicts"""
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, schema: Schema, values: tuple):
+        """
+        :param schema: columns of the row
+        :param values: values of the columns in order of schema
+        """
+        self._schema = schema
+        self._values = values
+
+    @classmethod
+    def from_dict(cls, row: Row) -> 'CompactRow':
+        return cls(Schema(row.keys()), tuple(row.values()))
+
+    @property
+    def schema(self) -> Schema:
+        return self._schema
+
+    def __getitem__(self, column: str) -> Any:
+        return self._values[self._schema.index[column]]
+
+    def __setitem__(self, column: str, value: Any) -> None:
+        index = self._schema.index.get(column)
+        if index is None:
+            self._schema = self._schema.extended(column)
+            self._values += (value,)
+        else:
+            values = self._values
+            self._values = values[:index] + (value,) + values[index + 1:]
+
+    def __delitem__(self, column: str) -> None:
+        index = self._schema.index[column]
+        columns = self._schema.columns
+        self._schema = Schema(columns[:index] + columns[index + 1:])
+        self._values = self._values[:index] + self._values[index + 1:]
+
+    def __iter__(self):
+        return iter(self._schema.columns)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __contains__(self, column) -> bool:
+        return column in self._schema.index
+
+    def __reduce__(self):
+        return CompactRow, (self._schema, self._values)
+
+    def __repr__(self):
+        return 'CompactRow({!r})'.format(self.to_dict())
+
+    def get(self, column: str, default: Any = None) -> Any:
+        index = self._schema.index.get(column)
+        return default if index is None else self._values[index]
+
+    def copy(self) -> 'CompactRow':
+        return CompactRow(self._schema, self._values)
+
+    def replaced(self, column: str, value: Any) -> 'CompactRow':
+        """Copy of the row with value of existing column replaced"""
+        index = self._schema.index[column]
+        values = self._values
+        return CompactRow(self._schema,
+                          values[:index] + (value,) + values[index + 1:])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(zip(self._schema.columns, self._values))
+
+
+def to_dict(row: Row) -> Dict[str, Any]:
+    """Plain dict of any row"""
+    if isinstance(row, CompactRow):
+        return row.to_dict()
+    return row
+
+
+def _ordering_prefix(ordering: Ordering, is_preserved) -> Ordering:
+    """Longest prefix of ordering made of columns satisfying is_preserved"""
+    prefix = []
+    for column in ordering:
+        if not is_preserved(column):
+            break
+        prefix.append(column)
+    return tuple(prefix)
+
+
+class _Descending:
+    """Value compared in reverse order, for descending columns of keys
+    mixing directions"""
+    __slots__ = ('value',)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __lt__(self, other: '_Descending') -> bool:
+        return other.value < self.value
+
+    def __eq__(self, other) -> bool:
+        return self.value == other.value
+
+
+@lru_cache(maxsize=None)
+def _compile_key(keys: Tuple[str, ...], descending: frozenset,
+                 as_tuple: bool):
+    if any(key in descending for key in keys):
+        getters = [(itemgetter(key), key in descending) for key in keys]
+
+        def key(row):
+            return tuple(_Descending(get(row)) if is_descending else get(row)
+                         for get, is_descending in getters)
+        return key
+    if not keys:
+        return lambda row: ()
+    if len(keys) == 1 and as_tuple:
+        get = itemgetter(keys[0])
+        return lambda row: (get(row),)
+    return itemgetter(*keys)
+
+
+def key_extractor(keys: Sequence[str], descending: Sequence[str] = (),
+                  as_tuple: bool = False):
+    """Function returning key of row by columns, compiled once for every
+    set of arguments, so operations with the same keys share it. Key of
+    a single column is its value unless as_tuple, otherwise it is a tuple.
+    Values of descending columns are wrapped to compare in reverse
+    :param keys: columns of key
+    :param descending: columns of key compared in descending order
+    :param as_tuple: make tuple for a single column too
+    """
+    return _compile_key(tuple(keys), frozenset(descending), as_tuple)
+
+
+def _describe(obj) -> str:
+    """Human readable description of operation with its parameters"""
+    parameters = []
+    for name, value in vars(obj).items():
+        if name.startswith('_') or value is None or value == ():
+            continue
+        if isinstance(value, FunctionType):
+            value = value.__name__
+        else:
+            value = repr(value)
+        parameters.append('{}={}'.format(name, value))
+    return '{}({})'.format(type(obj).__name__, ', '.join(parameters))
 
 
 class Operation(ABC):
+    # whether operation yields batches (see 'batch' module) instead of rows
+    produces_batches = False
+    # whether operation keeps rows in memory, limited by its 'memory_limit'
+    buffers_rows = False
+
     @abstractmethod
     def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
         pass
 
+    def __repr__(self):
+        return _describe(self)
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        """Ordering of the output given orderings of the inputs"""
+        return ()
+
+    def with_input_orderings(self, *input_orderings: Ordering) \
+            -> 'Operation':
+        """Same operation applied to inputs with other orderings"""
+        return self
+
+    def with_memory_limit(self, memory_limit: int) -> 'Operation':
+        """Same operation keeping at most about memory_limit bytes of rows
+        in memory and the rest in temporary files"""
+        if not self.buffers_rows:
+            return self
+        operation = copy.copy(self)
+        operation.memory_limit = memory_limit
+        return operation
+
 
 # Operations
 
@@ -24,6 +259,35 @@ class Mapper(ABC):
     def __call__(self, row: Row) -> OperationResult:
         pass
 
+    def __repr__(self):
+        return _describe(self)
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        """Part of the input ordering which survives the mapper"""
+        return ()
+
+    def apply(self, row: Row) -> List[Row]:
+        """Rows produced from the row, without generator overhead
+        where mapper supports it"""
+        return list(self(row))
+
+
+class RowMapper(Mapper):
+    """Base class for mappers producing at most one row from every row"""
+    @abstractmethod
+    def map_row(self, row: Row) -> Optional[Row]:
+        """Produced row or None if the row is dropped"""
+        pass
+
+    def __call__(self, row: Row) -> OperationResult:
+        new_row = self.map_row(row)
+        if new_row is not None:
+            yield new_row
+
+    def apply(self, row: Row) -> List[Row]:
+        new_row = self.map_row(row)
+        return [] if new_row is None else [new_row]
+
 
 class Map(Operation):
     def __init__(self, mapper: Mapper):
@@ -33,48 +297,526 @@ class Map(Operation):
         for row in rows:
             yield from self.mapper(row)
 
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return self.mapper.ordering(input_orderings[0])
+
 
 class Reducer(ABC):
-    """Base class for reducers"""
+    """Base class for reducers. Rows of a group are passed as a list (or
+    rows spilled to disk) which can be iterated several times, unless
+    reducer is streaming: then they are passed as a one-pass iterator and
+    the group is never kept in memory"""
+    # whether reducer reads rows of a group only once, in order
+    streaming = False
+
     @abstractmethod
     def __call__(self, group_key: Tuple[str], rows: Iterable[Row]) \
             -> OperationResult:
         pass
 
+    def __repr__(self):
+        return _describe(self)
 
-class Reduce(Operation):
-    def _leave_only_keys(self, row):
-        return [row[k] for k in self.keys]
 
-    def __init__(self, reducer: Reducer, keys: Sequence[str]):
+class Aggregator(Reducer):
+    """Base class for reducers which fold rows of a group into a state and
+    yield single row with the result in 'column'. States of parts of a group
+    can be merged, so rows don't have to be grouped or sorted beforehand"""
+    streaming = True
+
+    def __init__(self, column: str):
+        """
+        :param column: name of result column
+        """
+        self.column = column
+
+    @abstractmethod
+    def initial(self) -> Any:
+        """State for an empty group"""
+        pass
+
+    @abstractmethod
+    def update(self, state: Any, row: Row) -> Any:
+        """State after adding row"""
+        pass
+
+    @abstractmethod
+    def merge(self, state: Any, other: Any) -> Any:
+        """State of union of two parts of a group"""
+        pass
+
+    @abstractmethod
+    def result(self, state: Any) -> Any:
+        """Value of result column"""
+        pass
+
+    def update_batch(self, state: Any, batch) -> Any:
+        """State after adding all rows of the batch"""
+        for row in batch.rows():
+            state = self.update(state, row)
+        return state
+
+    def __call__(self, group_key: Tuple[str],
+                 rows: Iterable[Row]) -> OperationResult:
+        state = self.initial()
+        last_row = None
+        for last_row in rows:
+            state = self.update(state, last_row)
+        if last_row is None:
+            return
+        new_row = {key: last_row[key] for key in group_key}
+        new_row[self.column] = self.result(state)
+        yield new_row
+
+
+class Reduce(Operation):
+    def __init__(self, reducer: Reducer, keys: Sequence[str],
+                 memory_limit: int = None):
+        """
+        :param reducer: reducer to use
+        :param keys: keys for grouping
+        :param memory_limit: approximate number of bytes of rows of a group
+        kept in memory; larger groups are passed to reducer from
+        a temporary file. None means no limit
+        """
         self.reducer = reducer
         self.keys = keys
+        self.memory_limit = memory_limit
+
+    @property
+    def buffers_rows(self) -> bool:
+        return not self.reducer.streaming
+
+    def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
+        keys = tuple(self.keys)
+        if self.reducer.streaming:
+            # groupby skips whatever reducer leaves unread
+            for key, group in groupby(rows, key_extractor(keys)):
+                yield from self.reducer(keys, group)
+            return
+        for key, group in groupby(rows, key_extractor(keys)):
+            with _buffered(group, self.memory_limit) as group:
+                yield from self.reducer(keys, group)
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        # groups keep the input order and reducers keep key columns
+        return _ordering_prefix(input_orderings[0],
+                                lambda column: column in self.keys)
+
+
+class HashAggregate(Operation):
+    """Compute aggregators for every group in a single pass keeping partial
+    states in a dict instead of sorting rows. Groups are yielded in order
+    of their first rows"""
+    def __init__(self, aggregators: Sequence[Aggregator],
+                 keys: Sequence[str]):
+        """
+        :param aggregators: aggregators to compute, each yields own column
+        :param keys: keys for grouping
+        """
+        self.aggregators = list(aggregators)
+        self.keys = keys
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return _ordering_prefix(input_orderings[0],
+                                lambda column: column in self.keys)
+
+    def partial_states(self, rows: Iterable[Row]) -> Dict[tuple, list]:
+        """States of aggregators for every group of rows"""
+        states = {}
+        aggregators = list(enumerate(self.aggregators))
+        get_key = key_extractor(self.keys, as_tuple=True)
+        for row in rows:
+            key = get_key(row)
+            group_states = states.get(key)
+            if group_states is None:
+                group_states = states[key] = \
+                    [aggregator.initial() for aggregator in self.aggregators]
+            for index, aggregator in aggregators:
+                group_states[index] = aggregator.update(group_states[index],
+                                                        row)
+        return states
+
+    def merge_states(self, states: Dict[tuple, list],
+                     other: Dict[tuple, list]) -> None:
+        """Add other states of groups into states"""
+        for key, other_states in other.items():
+            group_states = states.get(key)
+            if group_states is None:
+                states[key] = other_states
+                continue
+            for index, aggregator in enumerate(self.aggregators):
+                group_states[index] = aggregator.merge(group_states[index],
+                                                       other_states[index])
+
+    def results(self, states: Dict[tuple, list]) -> OperationResult:
+        for key, group_states in states.items():
+            new_row = dict(zip(self.keys, key))
+            for aggregator, state in zip(self.aggregators, group_states):
+                new_row[aggregator.column] = aggregator.result(state)
+            yield new_row
 
     def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
-        for key, group in groupby(rows, self._leave_only_keys):
-            yield from self.reducer(tuple(self.keys), list(group))
+        yield from self.results(self.partial_states(rows))
+
+
+class TopK(Operation):
+    """Keep n rows with the largest values of column for every key while
+    streaming, in a bounded heap per key; input doesn't have to be sorted.
+    Groups are yielded in order of keys, rows of a group by descending
+    values, equal values in order of arrival"""
+    def __init__(self, column: str, n: int, keys: Sequence[str] = ()):
+        """
+        :param column: column to rank rows by
+        :param n: number of rows to keep for every key
+        :param keys: keys for grouping; all rows form a single group if empty
+        """
+        self.column = column
+        self.n = n
+        self.keys = keys
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return tuple(self.keys)
+
+    def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
+        if self.n <= 0:
+            return
+        get_key = key_extractor(self.keys, as_tuple=True)
+        get_value = itemgetter(self.column)
+        heaps = {}
+        # heap items are (value, -arrival, row): the smallest value and,
+        # among equal ones, the latest row is evicted first
+        for arrival, row in enumerate(rows):
+            key = get_key(row)
+            heap = heaps.get(key)
+            if heap is None:
+                heap = heaps[key] = []
+            item = (get_value(row), -arrival, row)
+            if len(heap) < self.n:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        for key in sorted(heaps):
+            for value, arrival, row in sorted(heaps[key], reverse=True):
+                yield row
 
 
 class CountAll(Operation):
-    def __init__(self, counter: Reducer, keys: Sequence[str]):
+    def __init__(self, counter: Reducer, keys: Sequence[str],
+                 memory_limit: int = None):
+        """
+        :param counter: reducer applied to all rows at once
+        :param keys: keys passed to reducer
+        :param memory_limit: approximate number of bytes of rows kept in
+        memory; the rest go to a temporary file. None means no limit
+        """
         self.reducer = counter
         self.keys = keys
+        self.memory_limit = memory_limit
+
+    @property
+    def buffers_rows(self) -> bool:
+        return not self.reducer.streaming
 
     def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
-        yield from self.reducer(tuple(self.keys), list(rows))
+        if self.reducer.streaming:
+            yield from self.reducer(tuple(self.keys), rows)
+            return
+        with _buffered(rows, self.memory_limit) as rows:
+            yield from self.reducer(tuple(self.keys), rows)
+
+
+def _column_sum(column) -> Any:
+    """Sum of a list or a NumPy array as Python number"""
+    if hasattr(column, 'dtype'):
+        return column.sum().item()
+    return sum(column)
+
+
+def _vector(column):
+    """Column of a batch as NumPy array"""
+    if hasattr(column, 'dtype'):
+        return column
+    return numpy.asarray(column)
+
+
+def _python_values(column) -> list:
+    """Column of a batch as list of Python values"""
+    if hasattr(column, 'dtype'):
+        return column.tolist()
+    return column
+
+
+def _estimate_size(row: Row) -> int:
+    """Rough estimate of memory occupied by row in bytes"""
+    return sys.getsizeof(row) + sum(sys.getsizeof(value)
+                                    for value in row.values())
+
+
+def _spill(rows: Iterable[Row]):
+    """Write rows into anonymous temporary file and rewind it"""
+    spill_file = tempfile.TemporaryFile()
+    for row in rows:
+        pickle.dump(row, spill_file, pickle.HIGHEST_PROTOCOL)
+    spill_file.seek(0)
+    return spill_file
+
+
+class _SpilledRows:
+    """Rows stored in a temporary file which can be iterated several times
+    """
+    def __init__(self, rows: Iterable[Row]):
+        descriptor, self._path = tempfile.mkstemp(suffix='.rows')
+        self._length = 0
+        with os.fdopen(descriptor, 'wb') as spill_file:
+            for row in rows:
+                pickle.dump(row, spill_file, pickle.HIGHEST_PROTOCOL)
+                self._length += 1
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> OperationResult:
+        return _read_spilled(open(self._path, 'rb'))
+
+    def close(self) -> None:
+        os.remove(self._path)
+
+
+@contextmanager
+def _buffered(rows: Iterable[Row], memory_limit: int = None):
+    """Rows as a list, or as '_SpilledRows' when they exceed memory_limit;
+    spilled rows are removed on exit"""
+    buffered = []
+    buffered_size = 0
+    rows = iter(rows)
+    for row in rows:
+        buffered.append(row)
+        if memory_limit is None:
+            continue
+        buffered_size += _estimate_size(row)
+        if buffered_size > memory_limit:
+            spilled = _SpilledRows(chain(buffered, rows))
+            del buffered
+            try:
+                yield spilled
+            finally:
+                spilled.close()
+            return
+    yield buffered
+
+
+def _read_spilled(spill_file) -> OperationResult:
+    """Yield rows from file written by '_spill' and close it afterwards"""
+    with spill_file:
+        while True:
+            try:
+                yield pickle.load(spill_file)
+            except EOFError:
+                break
 
 
 class Sort(Operation):
-    def __init__(self, keys: Sequence[str]):
+    buffers_rows = True
+    # maximal number of spilled runs open at once; more runs are merged
+    # into a single spilled run first
+    max_merged_runs = 64
+
+    def __init__(self, keys: Sequence[str], memory_limit: int = None,
+                 input_ordering: Ordering = (),
+                 descending: Sequence[str] = ()):
+        """
+        :param keys: sorting keys
+        :param memory_limit: approximate number of bytes of rows kept in
+        memory; sorted runs exceeding it are spilled to temporary files and
+        merged afterwards. None means sorting fully in memory
+        :param input_ordering: ordering guaranteed by the input; sorting is
+        skipped when keys are its prefix
+        :param descending: keys to sort in descending order
+        """
         self.keys = keys
+        self.memory_limit = memory_limit
+        self._input_ordering = tuple(input_ordering)
+        self.descending = tuple(descending)
+
+    def is_redundant(self) -> bool:
+        return not self.descending and \
+            self._input_ordering[:len(self.keys)] == tuple(self.keys)
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        if self.descending:
+            # ordering describes ascending columns only
+            return tuple(takewhile(lambda key: key not in self.descending,
+                                   self.keys))
+        if input_orderings[0][:len(self.keys)] == tuple(self.keys):
+            return input_orderings[0]
+        return tuple(self.keys)
+
+    def with_input_orderings(self, *input_orderings: Ordering) -> 'Sort':
+        return Sort(self.keys, memory_limit=self.memory_limit,
+                    input_ordering=input_orderings[0],
+                    descending=self.descending)
+
+    def _sort_key(self):
+        """Key function and whether it is used in reverse"""
+        if self.descending and set(self.keys) <= set(self.descending):
+            # reversed sort is stable too and needs no wrapped values
+            return key_extractor(self.keys), True
+        return key_extractor(self.keys, self.descending), False
+
+    def _merged_run(self, runs: list, key, reverse: bool):
+        """Single spilled run with rows of consecutive runs; merging them
+        keeps the sort stable"""
+        return _spill(heapq.merge(*(_read_spilled(f) for f in runs),
+                                  key=key, reverse=reverse))
+
+    def _sorted_runs(self, rows: Iterable[Row], key, reverse: bool):
+        """Spilled sorted runs, at most 'max_merged_runs' - 1 of them, and
+        the last sorted run kept in memory.
+        Spilled runs are merged in tiers: every 'max_merged_runs' runs of a
+        level make one run of the next level, so every row is written about
+        log(number of runs, max_merged_runs) times"""
+        levels = [[]]
+        run = []
+        run_size = 0
+        for row in rows:
+            run.append(row)
+            run_size += _estimate_size(row)
+            if run_size > self.memory_limit:
+                run.sort(key=key, reverse=reverse)
+                levels[0].append(_spill(run))
+                run = []
+                run_size = 0
+                for level, runs in enumerate(levels):
+                    if len(runs) < self.max_merged_runs:
+                        break
+                    if level + 1 == len(levels):
+                        levels.append([])
+                    levels[level + 1].append(
+                        self._merged_run(runs, key, reverse))
+                    runs.clear()
+        run.sort(key=key, reverse=reverse)
+        # runs of higher levels hold earlier rows
+        spilled = [f for runs in reversed(levels) for f in runs]
+        while len(spilled) >= self.max_merged_runs:
+            # the last runs are the smallest ones
+            tail = len(spilled) - self.max_merged_runs
+            spilled[tail:] = [self._merged_run(spilled[tail:], key, reverse)]
+        return spilled, run
 
     def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
-        yield from sorted(rows,
-                          key=lambda row: [row[k] for k in self.keys])
+        if self.is_redundant():
+            yield from rows
+            return
+        key, reverse = self._sort_key()
+        if self.memory_limit is None:
+            yield from sorted(rows, key=key, reverse=reverse)
+            return
+        spilled, in_memory = self._sorted_runs(rows, key, reverse)
+        # heapq.merge prefers earlier runs on equal keys, so the merge is
+        # stable exactly like the in-memory sort
+        yield from heapq.merge(*(_read_spilled(f) for f in spilled),
+                               in_memory, key=key, reverse=reverse)
+
+
+class JoinStats:
+    """Sizes of groups of rows with equal keys joined by sort-merge join,
+    for diagnosing skew. Pass it to 'Join' and read it after the run; joins
+    collecting statistics are not kept in the result store"""
+    __slots__ = ('groups', 'max_left', 'max_right', 'products',
+                 'spilled_groups', 'top', '_heaviest', '_recorded')
+
+    def __init__(self, top: int = 10):
+        """
+        :param top: number of groups with the largest products to keep
+        """
+        self.top = top
+        self.groups = 0
+        self.max_left = 0
+        self.max_right = 0
+        self.products = 0
+        self.spilled_groups = 0
+        self._heaviest = []  # type: List[Tuple[int, int, Any, int, int]]
+        self._recorded = 0
+
+    def record(self, key: Any, left_size: int, right_size: int,
+               spilled: bool = False) -> None:
+        """Add a group with left_size and right_size rows"""
+        self.groups += 1
+        self.max_left = max(self.max_left, left_size)
+        self.max_right = max(self.max_right, right_size)
+        self.products += left_size * right_size
+        self.spilled_groups += spilled
+        # recording number breaks ties, so keys are never compared
+        self._recorded -= 1
+        item = (left_size * right_size, self._recorded, key,
+                left_size, right_size)
+        if len(self._heaviest) < self.top:
+            heapq.heappush(self._heaviest, item)
+        elif item > self._heaviest[0]:
+            heapq.heapreplace(self._heaviest, item)
+
+    @property
+    def heaviest(self) -> List[Tuple[Any, int, int]]:
+        """(key, left size, right size) of groups with the largest
+        products, the largest first"""
+        return [(key, left_size, right_size) for _, _, key, left_size,
+                right_size in sorted(self._heaviest, reverse=True)]
+
+    def report(self) -> str:
+        lines = ['{} groups, {} rows produced, {} spilled; largest groups: '
+                 '{} left, {} right rows'.format(
+                     self.groups, self.products, self.spilled_groups,
+                     self.max_left, self.max_right)]
+        for key, left_size, right_size in self.heaviest:
+            lines.append('{!r}: {} x {}'.format(key, left_size, right_size))
+        return '\n'.join(lines)
+
+
+@lru_cache(maxsize=1024)
+def _merge_layout(keys: Tuple[str, ...], left_columns: Tuple[str, ...],
+                  right_columns: Tuple[str, ...], suffix_a: str,
+                  suffix_b: str) -> Tuple[Tuple[str, int, str], ...]:
+    """See 'Joiner.merge_layout'"""
+    right_set = set(right_columns)
+    left_set = set(left_columns)
+    layout = []
+    for key in left_columns:
+        if key in right_set and key not in keys:
+            layout.append((key + suffix_a, 0, key))
+            layout.append((key + suffix_b, 1, key))
+    layout.extend((key, 0, key) for key in left_columns
+                  if key not in right_set)
+    layout.extend((key, 1, key) for key in right_columns
+                  if key not in left_set)
+    layout.extend((key, 0, key) for key in keys)
+    return tuple(layout)
+
+
+@lru_cache(maxsize=1024)
+def _merge_plan(keys: Tuple[str, ...], left_columns: Tuple[str, ...],
+                right_columns: Tuple[str, ...], suffix_a: str,
+                suffix_b: str) -> Tuple[Schema, Tuple[Tuple[str, int, str],
+                                                      ...]]:
+    """Schema of merged rows and merge layout with a single entry for
+    every column, at the place where the column appears first"""
+    layout = {}
+    for column, side, source in _merge_layout(keys, left_columns,
+                                              right_columns, suffix_a,
+                                              suffix_b):
+        # like assignments into a dict: the first place, the last source
+        layout[column] = (column, side, source)
+    return Schema(layout), tuple(layout.values())
 
 
 class Joiner(ABC):
     """Base class for joiners"""
+    # approximate number of bytes of rows of a group kept in memory by
+    # '_simple_join'; None means no limit
+    memory_limit = None
+    # statistics of joined groups, if they are collected
+    stats = None  # type: JoinStats
+
     def __init__(self, suffix_a: str = '_1', suffix_b: str = '_2'):
         self._a_suffix = suffix_a
         self._b_suffix = suffix_b
@@ -93,45 +835,232 @@ class Joiner(ABC):
                  rows_b: Iterable[Row]) -> OperationResult:
         pass
 
-    def _merge_row(self, keys: Sequence[str],
-                   row_left: Row, row_right: Row) -> Dict:
-        new_row = {}
-        duplicate_keys = [key for key in row_left.keys()
-                          if key in row_right.keys() and key not in keys]
-        left_keys = [key for key in row_left.keys()
-                     if key not in row_right.keys()]
-        right_keys = [key for key in row_right.keys()
-                      if key not in row_left.keys()]
-
-        for key in duplicate_keys:
-            new_row[key + self._a_suffix] = row_left[key]
-            new_row[key + self._b_suffix] = row_right[key]
+    def __repr__(self):
+        return _describe(self)
 
-        for key in left_keys:
-            new_row[key] = row_left[key]
+    @property
+    def suffixes(self) -> Tuple[str, str]:
+        """Suffixes of columns present in both joined rows"""
+        return self._a_suffix, self._b_suffix
 
-        for key in right_keys:
-            new_row[key] = row_right[key]
-
-        for key in keys:
-            new_row[key] = row_left[key]
-
-        yield new_row
+    def _merge_row(self, keys: Sequence[str],
+                   row_left: Row, row_right: Row) -> Dict:
+        # layout is computed once for all pairs of rows with the same columns
+        schema, layout = _merge_plan(tuple(keys), tuple(row_left),
+                                     tuple(row_right), self._a_suffix,
+                                     self._b_suffix)
+        pair = (row_left, row_right)
+        if isinstance(row_left, CompactRow) or \
+                isinstance(row_right, CompactRow):
+            yield CompactRow(schema, tuple([pair[side][source]
+                                            for _, side, source in layout]))
+        else:
+            yield {column: pair[side][source]
+                   for column, side, source in layout}
+
+    def merge_layout(self, keys: Sequence[str], left_columns: Sequence[str],
+                     right_columns: Sequence[str]) \
+            -> List[Tuple[str, int, str]]:
+        """Columns of rows built by '_merge_row' from rows with given columns
+        :return: list of (result column, side (0 - left, 1 - right),
+        source column) in order of '_merge_row'
+        """
+        return list(_merge_layout(tuple(keys), tuple(left_columns),
+                                  tuple(right_columns), self._a_suffix,
+                                  self._b_suffix))
+
+    def for_groups(self, memory_limit: int = None,
+                   stats: JoinStats = None) -> 'Joiner':
+        """Same joiner spilling groups exceeding memory_limit bytes to disk
+        and recording sizes of groups into stats"""
+        if memory_limit is None and stats is None:
+            return self
+        joiner = copy.copy(self)
+        joiner.memory_limit = memory_limit
+        joiner.stats = stats
+        return joiner
 
     def _simple_join(self, rows_a, rows_b, keys):
-        a_rows_list = list(rows_a)
-        b_rows_list = list(rows_b)
-        for row_a in a_rows_list:
-            for row_b in b_rows_list:
-                yield from self._merge_row(keys, row_a, row_b)
+        """Merge every row of rows_a with every row of rows_b, in order of
+        rows_a whatever the memory limit. Only rows_b are buffered; when
+        they exceed memory limit they are spilled and read from disk for
+        every row of rows_a"""
+        a_size = 0
+        row_a = None
+        with _buffered(rows_b, self.memory_limit) as b_rows:
+            for row_a in rows_a:
+                a_size += 1
+                for row_b in b_rows:
+                    yield from self._merge_row(keys, row_a, row_b)
+            b_size = len(b_rows)
+            spilled = not isinstance(b_rows, list)
+        if self.stats is not None and a_size and b_size:
+            self.stats.record(tuple(row_a[key] for key in keys),
+                              a_size, b_size, spilled)
+
+
+def _take(rows: Iterable[Row], limit: int, memory_limit: int = None):
+    """Read at most limit + 1 rows or rows exceeding memory_limit bytes;
+    tell whether the input fits into both limits"""
+    if memory_limit is None:
+        head = list(islice(rows, limit + 1))
+        return head, len(head) <= limit
+    head = []
+    head_size = 0
+    for row in rows:
+        head.append(row)
+        head_size += _estimate_size(row)
+        if len(head) > limit or head_size > memory_limit:
+            return head, False
+    return head, True
 
 
 class Join(Operation):
-    def __init__(self, joiner: Joiner, keys: Sequence[str]):
+    buffers_rows = True
+    strategies = ('sort', 'hash', 'auto')
+
+    def __init__(self, joiner: Joiner, keys: Sequence[str],
+                 strategy: str = 'auto', size_hint: int = None,
+                 hash_join_limit: int = 100000,
+                 input_orderings: Tuple[Ordering, Ordering] = ((), ()),
+                 memory_limit: int = None, stats: JoinStats = None):
+        """
+        :param joiner: join strategy to use
+        :param keys: keys for joining
+        :param strategy: 'sort' for sort-merge join, 'hash' for hash join
+        with the smaller input as build side, 'auto' for sort-merge join
+        unless size_hint is passed, then hash join is used when one of the
+        inputs has at most hash_join_limit rows. Output of hash join is not
+        sorted by keys, and only inner, left, right and outer joiners are
+        applied by it; other joiners always get whole groups of sort-merge
+        join
+        :param size_hint: expected number of rows in the right input;
+        when passed it is trusted instead of inspecting the input
+        :param hash_join_limit: maximal number of rows in build side
+        :param input_orderings: orderings guaranteed by the left and the right
+        inputs; sort-merge join doesn't sort inputs which are already ordered
+        :param memory_limit: approximate number of bytes of rows kept in
+        memory: build side of hash join must fit into it, sort-merge join
+        sorts externally and spills large groups of equal keys. None means
+        no limit
+        :param stats: statistics to record sizes of joined groups into;
+        when passed, sort-merge join is used whatever the strategy
+        """
+        if strategy not in self.strategies:
+            raise ValueError('unknown join strategy {!r}'.format(strategy))
         self.keys = keys
         self.joiner = joiner
+        self.strategy = strategy
+        self.size_hint = size_hint
+        self.hash_join_limit = hash_join_limit
+        self.memory_limit = memory_limit
+        self.stats = stats
+        self._input_orderings = tuple(tuple(ordering)
+                                      for ordering in input_orderings)
+        # output is sorted by keys in their order, so an input ordered by
+        # the same keys in another order is sorted again
+        self._merge_keys = tuple(keys)
+
+    def _is_presorted(self, side: int) -> bool:
+        ordering = self._input_orderings[side]
+        return ordering[:len(self._merge_keys)] == self._merge_keys
+
+    def merges_rows(self) -> bool:
+        """Whether the joiner is a built-in one, which builds output rows
+        from input rows by 'Joiner._merge_row' and keeps their keys"""
+        return type(self.joiner) in (InnerJoiner, LeftJoiner, RightJoiner,
+                                     OuterJoiner)
+
+    def _uses_merge_join(self) -> bool:
+        # group sizes are known to sort-merge join only
+        if self.strategy == 'sort' or self.stats is not None or \
+                not self.merges_rows():
+            return True
+        return self.strategy == 'auto' and (
+            self.size_hint is None or
+            self._is_presorted(0) and self._is_presorted(1))
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return self._merge_keys if self._uses_merge_join() else ()
+
+    def with_input_orderings(self, *input_orderings: Ordering) -> 'Join':
+        return Join(self.joiner, self.keys, strategy=self.strategy,
+                    size_hint=self.size_hint,
+                    hash_join_limit=self.hash_join_limit,
+                    input_orderings=input_orderings,
+                    memory_limit=self.memory_limit, stats=self.stats)
 
     def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
+        if self._uses_merge_join():
+            yield from self._sort_merge_join(rows, args[0])
+            return
+
+        left, right = iter(rows), iter(args[0])
+        if self.size_hint is not None:
+            right_head, right_is_small = \
+                list(islice(right, 1)), self.size_hint <= self.hash_join_limit
+        else:
+            right_head, right_is_small = _take(right, self.hash_join_limit,
+                                               self.memory_limit)
+        right = chain(right_head, right)
+        left_first = list(islice(left, 1))
+        left = chain(left_first, left)
+        # keys like lists can't be put into a hash table, only sorted
+        hashable = self.strategy == 'hash' or \
+            self._has_hashable_key(right_head) and \
+            self._has_hashable_key(left_first)
+        if right_is_small and hashable:
+            yield from self._hash_join(left, right, build_left=False)
+            return
+        if not hashable:
+            yield from self._sort_merge_join(left, right)
+            return
+
+        left_head, left_is_small = _take(left, self.hash_join_limit,
+                                         self.memory_limit)
+        left = chain(left_head, left)
+        if left_is_small or self.strategy == 'hash':
+            yield from self._hash_join(right, left, build_left=True)
+        else:
+            yield from self._sort_merge_join(left, right)
+
+    def _has_hashable_key(self, rows: Sequence[Row]) -> bool:
+        """Whether keys of rows can be hashed, judging by the first row"""
+        if not rows:
+            return True
+        try:
+            hash(key_extractor(self.keys)(rows[0]))
+        except TypeError:
+            return False
+        return True
+
+    def _hash_join(self, probe_rows: Iterable[Row], build_rows: Iterable[Row],
+                   build_left: bool) -> OperationResult:
+        get_key = key_extractor(self.keys)
+        table = {}
+        for row in build_rows:
+            table.setdefault(get_key(row), []).append(row)
+
+        matched = set()
+        for row in probe_rows:
+            key = get_key(row)
+            group = table.get(key)
+            if group is not None:
+                matched.add(key)
+            if build_left:
+                yield from self.joiner(self.keys, group, [row])
+            else:
+                yield from self.joiner(self.keys, [row], group)
+
+        for key, group in table.items():
+            if key not in matched:
+                if build_left:
+                    yield from self.joiner(self.keys, group, None)
+                else:
+                    yield from self.joiner(self.keys, None, group)
+
+    def _sort_merge_join(self, rows_a: Iterable[Row],
+                         rows_b: Iterable[Row]) -> OperationResult:
 
         def check_move_right(left_key, right_key):
             return (left_key is not None and right_key is not None)\
@@ -143,42 +1072,109 @@ class Join(Operation):
                     left_key < right_key \
                     or right_key is None
 
-        left_pointer = groupby(Sort(self.keys)(rows),
-                               lambda row: tuple(row[key]
-                                                 for key in self.keys))
-        right_pointer = groupby(Sort(self.keys)(args[0]),
-                                lambda row: tuple(row[key]
-                                                  for key in self.keys))
+        if not self._is_presorted(0):
+            rows_a = Sort(self._merge_keys,
+                          memory_limit=self.memory_limit)(rows_a)
+        if not self._is_presorted(1):
+            rows_b = Sort(self._merge_keys,
+                          memory_limit=self.memory_limit)(rows_b)
+        joiner = self.joiner.for_groups(self.memory_limit, self.stats)
+        # tuple keys are never None, which marks the end of input
+        merge_key = key_extractor(self._merge_keys, as_tuple=True)
+        left_pointer = groupby(rows_a, merge_key)
+        right_pointer = groupby(rows_b, merge_key)
 
         left_key, left_rows_group = Joiner.next(left_pointer)
         right_key, right_rows_group = Joiner.next(right_pointer)
 
         while left_key is not None or right_key is not None:
             if check_move_right(left_key, right_key):
-                yield from self.joiner(self.keys, None, right_rows_group)
+                yield from joiner(self.keys, None, right_rows_group)
                 right_key, right_rows_group = Joiner.next(right_pointer)
 
             elif check_move_left(left_key, right_key):
-                yield from self.joiner(self.keys, left_rows_group, None)
+                yield from joiner(self.keys, left_rows_group, None)
                 left_key, left_rows_group = Joiner.next(left_pointer)
             else:
-                yield from self.joiner(self.keys, left_rows_group,
-                                       right_rows_group)
+                yield from joiner(self.keys, left_rows_group,
+                                  right_rows_group)
                 left_key, left_rows_group = Joiner.next(left_pointer)
                 right_key, right_rows_group = Joiner.next(right_pointer)
 
 
+class FusedMap(Operation):
+    """Apply chain of mappers to every row in a single loop.
+    Row mappers are called directly; rows of other mappers are pulled from
+    their generators one at a time, depth-first, to keep the order and
+    laziness of Map chain"""
+    def __init__(self, mappers: Sequence[Mapper]):
+        """
+        :param mappers: mappers in order of application
+        """
+        self.mappers = list(mappers)
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        ordering = input_orderings[0]
+        for mapper in self.mappers:
+            ordering = mapper.ordering(ordering)
+        return ordering
+
+    def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
+        steps = [(mapper.map_row, False) if isinstance(mapper, RowMapper)
+                 else (mapper, True) for mapper in self.mappers]
+        if not any(expands for _, expands in steps):
+            yield from self._map_rows([function for function, _ in steps],
+                                      rows)
+            return
+
+        steps_count = len(steps)
+        # iterators of rows with index of the step they go to next
+        pending = [(iter(rows), 0)]
+        while pending:
+            iterator, index = pending[-1]
+            row = next(iterator, None)
+            if row is None:
+                pending.pop()
+                continue
+            while index < steps_count:
+                function, expands = steps[index]
+                index += 1
+                if expands:
+                    pending.append((iter(function(row)), index))
+                    break
+                row = function(row)
+                if row is None:
+                    break
+            else:
+                yield row
+
+    @staticmethod
+    def _map_rows(functions, rows: Iterable[Row]) -> OperationResult:
+        for row in rows:
+            for function in functions:
+                row = function(row)
+                if row is None:
+                    break
+            else:
+                yield row
+
+
 # Dummy operators
 
 
-class DummyMapper(Mapper):
+class DummyMapper(RowMapper):
     """Yield exactly the row passed"""
-    def __call__(self, row: Row) -> OperationResult:
-        yield row
+    def map_row(self, row: Row) -> Optional[Row]:
+        return row
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return input_ordering
 
 
 class FirstReducer(Reducer):
     """Yield only first row from passed ones"""
+    streaming = True
+
     def __call__(self, group_key: Tuple[str],
                  rows: Iterable[Row]) -> OperationResult:
         for row in rows:
@@ -189,22 +1185,38 @@ class FirstReducer(Reducer):
 # Mappers
 
 
-class FilterPunctuation(Mapper):
+class Compact(RowMapper):
+    """Convert row to 'CompactRow'; Split, Project and joins of compact
+    rows produce compact rows sharing schemas instead of copying dicts"""
+    def map_row(self, row: Row) -> Optional[Row]:
+        if isinstance(row, CompactRow):
+            return row
+        return CompactRow.from_dict(row)
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return input_ordering
+
+
+class FilterPunctuation(RowMapper):
     """Left only non-punctuation symbols"""
+    _punctuation_table = str.maketrans('', '', string.punctuation)
+
     def __init__(self, column: str):
         """
         :param column: name of column to process
         """
         self.column = column
 
-    def __call__(self, row: Row) -> OperationResult:
-        punctuation = set(string.punctuation)
-        row[self.column] = ''.join(char for char in
-                                   row[self.column] if char not in punctuation)
-        yield row
+    def map_row(self, row: Row) -> Optional[Row]:
+        row[self.column] = row[self.column].translate(self._punctuation_table)
+        return row
 
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return _ordering_prefix(input_ordering,
+                                lambda column: column != self.column)
 
-class LowerCase(Mapper):
+
+class LowerCase(RowMapper):
     """Replace column value with value in lower case"""
     def __init__(self, column: str):
         """
@@ -212,9 +1224,13 @@ class LowerCase(Mapper):
         """
         self.column = column
 
-    def __call__(self, row: Row) -> OperationResult:
+    def map_row(self, row: Row) -> Optional[Row]:
         row[self.column] = row[self.column].lower()
-        yield row
+        return row
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return _ordering_prefix(input_ordering,
+                                lambda column: column != self.column)
 
 
 class Split(Mapper):
@@ -228,14 +1244,25 @@ class Split(Mapper):
         self.separator = separator
 
     def __call__(self, row: Row) -> OperationResult:
+        yield from self.apply(row)
+
+    def apply(self, row: Row) -> List[Row]:
         splitted = row[self.column].split(self.separator)
+        if isinstance(row, CompactRow):
+            return [row.replaced(self.column, value) for value in splitted]
+        new_rows = []
         for column in splitted:
             new_raw = row.copy()
             new_raw[self.column] = column
-            yield new_raw
+            new_rows.append(new_raw)
+        return new_rows
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return _ordering_prefix(input_ordering,
+                                lambda column: column != self.column)
 
 
-class Product(Mapper):
+class Product(RowMapper):
     """Calculates product of multiple columns"""
     def __init__(self, columns: Sequence[str],
                  result_column: str = 'product'):
@@ -246,14 +1273,35 @@ class Product(Mapper):
         self.columns = columns
         self.result_column = result_column
 
-    def __call__(self, row: Row) -> OperationResult:
+    def map_row(self, row: Row) -> Optional[Row]:
         row[self.result_column] = 1
         for key in self.columns:
             row[self.result_column] *= row[key]
-        yield row
-
-
-class Idf(Mapper):
+        return row
+
+    def map_batch(self, batch):
+        vectors = None if numpy is None else \
+            [_vector(batch[key]) for key in self.columns]
+        # products of NumPy integers wrap around on overflow unlike Python
+        # integers, so only floats are multiplied by NumPy
+        if vectors is None or \
+                not all(vector.dtype.kind == 'f' for vector in vectors):
+            result = [1] * len(batch)
+            for key in self.columns:
+                result = [product * value for product, value
+                          in zip(result, _python_values(batch[key]))]
+            return batch.with_column(self.result_column, result)
+        result = 1
+        for vector in vectors:
+            result = result * vector
+        return batch.with_column(self.result_column, result)
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return _ordering_prefix(input_ordering,
+                                lambda column: column != self.result_column)
+
+
+class Idf(RowMapper):
     """Calculates idf"""
     def __init__(self, column1: str, column2: str,
                  result_column: str = 'product'):
@@ -266,26 +1314,147 @@ class Idf(Mapper):
         self.column2 = column2
         self.result_column = result_column
 
-    def __call__(self, row: Row) -> OperationResult:
+    def map_row(self, row: Row) -> Optional[Row]:
         row[self.result_column] = \
             math.log(row[self.column2] / row[self.column1])
-        yield row
+        return row
 
+    def map_batch(self, batch):
+        if numpy is None:
+            result = [math.log(value2 / value1) for value1, value2
+                      in zip(batch[self.column1], batch[self.column2])]
+        else:
+            denominators = _vector(batch[self.column1])
+            # NumPy would give inf or nan with a warning; fail like rows do
+            if (denominators == 0).any():
+                raise ZeroDivisionError('division by zero')
+            ratios = _vector(batch[self.column2]) / denominators
+            if (ratios <= 0).any():
+                raise ValueError('math domain error')
+            result = numpy.log(ratios)
+        return batch.with_column(self.result_column, result)
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return _ordering_prefix(input_ordering,
+                                lambda column: column != self.result_column)
+
+
+class Divide(RowMapper):
+    """Calculates quotient of two columns"""
+    def __init__(self, numerator: str, denominator: str,
+                 result_column: str = 'quotient'):
+        """
+        :param numerator: column of numerator
+        :param denominator: column of denominator
+        :param result_column: column name to save quotient in
+        """
+        self.numerator = numerator
+        self.denominator = denominator
+        self.result_column = result_column
+
+    def map_row(self, row: Row) -> Optional[Row]:
+        row[self.result_column] = \
+            float(row[self.numerator]) / row[self.denominator]
+        return row
+
+    def map_batch(self, batch):
+        if numpy is None:
+            result = [float(numerator) / denominator
+                      for numerator, denominator
+                      in zip(batch[self.numerator], batch[self.denominator])]
+        else:
+            denominators = _vector(batch[self.denominator])
+            # NumPy would give inf with a warning; fail like rows do
+            if (denominators == 0).any():
+                raise ZeroDivisionError('float division by zero')
+            result = _vector(batch[self.numerator]) / denominators
+        return batch.with_column(self.result_column, result)
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return _ordering_prefix(input_ordering,
+                                lambda column: column != self.result_column)
+
+
+class Haversine(RowMapper):
+    """Calculates great-circle distance in km between two points given
+    as [longitude, latitude] in degrees"""
+    EARTH_RADIUS = 6371.0  # km
 
-class Filter(Mapper):
+    def __init__(self, start_column: str, end_column: str,
+                 result_column: str = 'distance'):
+        """
+        :param start_column: column with coordinates of the first point
+        :param end_column: column with coordinates of the second point
+        :param result_column: column name to save distance in
+        """
+        self.start_column = start_column
+        self.end_column = end_column
+        self.result_column = result_column
+
+    @classmethod
+    def distance(cls, start: Sequence[float], end: Sequence[float]) -> float:
+        lon1, lat1 = start
+        lon2, lat2 = end
+        dlat = math.radians(lat2 - lat1)
+        dlon = math.radians(lon2 - lon1)
+        a = (math.sin(dlat / 2) * math.sin(dlat / 2) +
+             math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+             math.sin(dlon / 2) * math.sin(dlon / 2))
+        return cls.EARTH_RADIUS * 2 * math.atan2(math.sqrt(a),
+                                                 math.sqrt(1 - a))
+
+    def map_row(self, row: Row) -> Optional[Row]:
+        row[self.result_column] = self.distance(row[self.start_column],
+                                                row[self.end_column])
+        return row
+
+    def map_batch(self, batch):
+        if numpy is None or not len(batch):
+            result = [self.distance(start, end) for start, end
+                      in zip(batch[self.start_column],
+                             batch[self.end_column])]
+            return batch.with_column(self.result_column, result)
+        start = numpy.radians(numpy.asarray(batch[self.start_column],
+                                            dtype=numpy.float64))
+        end = numpy.radians(numpy.asarray(batch[self.end_column],
+                                          dtype=numpy.float64))
+        dlon, dlat = (end - start).T
+        a = numpy.sin(dlat / 2) ** 2 + \
+            numpy.cos(start[:, 1]) * numpy.cos(end[:, 1]) * \
+            numpy.sin(dlon / 2) ** 2
+        result = self.EARTH_RADIUS * 2 * numpy.arctan2(numpy.sqrt(a),
+                                                       numpy.sqrt(1 - a))
+        return batch.with_column(self.result_column, result)
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return _ordering_prefix(input_ordering,
+                                lambda column: column != self.result_column)
+
+
+class Filter(RowMapper):
     """Remove records that don't satisfy some condition"""
-    def __init__(self, condition: FunctionType):
+    def __init__(self, condition: FunctionType,
+                 columns: Sequence[str] = None):
         """
         :param condition: if condition is not true - remove record
+        :param columns: names of columns condition depends on, if known;
+        lets the optimizer move the filter closer to the data source
         """
         self.condition = condition
+        self.columns = columns
 
-    def __call__(self, row: Row) -> OperationResult:
-        if self.condition(row):
-            yield row
+    def map_row(self, row: Row) -> Optional[Row]:
+        return row if self.condition(row) else None
+
+    def map_batch(self, batch):
+        return batch.take([index for index, row in enumerate(batch.rows())
+                           if self.condition(row)])
 
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return input_ordering
 
-class ApplyFunction(Mapper):
+
+class ApplyFunction(RowMapper):
     """Applies function to two given columns"""
     def __init__(self, func: FunctionType, result_column: str = 'result'):
         """
@@ -296,9 +1465,98 @@ class ApplyFunction(Mapper):
         self.result_column = result_column
         self.func = func
 
-    def __call__(self, row: Row) -> OperationResult:
+    def map_row(self, row: Row) -> Optional[Row]:
         row[self.result_column] = self.func(row)
-        yield row
+        return row
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return _ordering_prefix(input_ordering,
+                                lambda column: column != self.result_column)
+
+
+class ParseTimestamp(RowMapper):
+    """Parses timestamps of format '%Y%m%dT%H%M%S[.%f]' by slicing the
+    string once and stores microseconds since epoch, weekday and hour.
+    Microseconds are integer, so differences of timestamps are exact"""
+    _weekdays = [name[:3] for name in calendar.day_name]
+    _epoch = datetime.date(1970, 1, 1).toordinal()
+    # memoized values by mapper; kept out of the mapper so that its
+    # fingerprint doesn't change after a run
+    _memos = weakref.WeakKeyDictionary()
+
+    def __init__(self, column: str, microseconds_column: str = None,
+                 weekday_column: str = None, hour_column: str = None,
+                 memoize: int = 0):
+        """
+        :param column: name of column with timestamp
+        :param microseconds_column: column for microseconds since epoch
+        (int), not stored if not passed
+        :param weekday_column: column for first three letters of weekday
+        name, not stored if not passed
+        :param hour_column: column for hour, not stored if not passed
+        :param memoize: number of distinct timestamps to remember parsed
+        values of; 0 disables memoization
+        """
+        self.column = column
+        self.microseconds_column = microseconds_column
+        self.weekday_column = weekday_column
+        self.hour_column = hour_column
+        self.memoize = memoize
+
+    @classmethod
+    def parse(cls, timestamp: str) -> Tuple[int, str, int]:
+        """Microseconds since epoch, weekday and hour of the timestamp"""
+        fraction = timestamp[16:]
+        if len(timestamp) < 15 or timestamp[8] != 'T' or \
+                len(timestamp) > 15 and (timestamp[15] != '.' or
+                                         not 0 < len(fraction) <= 6):
+            raise ValueError('unknown timestamp format: {!r}'
+                             .format(timestamp))
+        date = datetime.date(int(timestamp[0:4]), int(timestamp[4:6]),
+                             int(timestamp[6:8]))
+        hour = int(timestamp[9:11])
+        seconds = (date.toordinal() - cls._epoch) * 86400 + hour * 3600 + \
+            int(timestamp[11:13]) * 60 + int(timestamp[13:15])
+        # '%f' pads fraction with zeros on the right
+        microseconds = int(fraction.ljust(6, '0')) if fraction else 0
+        return seconds * 1000000 + microseconds, \
+            cls._weekdays[date.weekday()], hour
+
+    def _parse(self, timestamp: str) -> Tuple[int, str, int]:
+        if not self.memoize:
+            return self.parse(timestamp)
+        memo = self._memos.get(self)
+        if memo is None:
+            memo = self._memos[self] = {}
+        parsed = memo.get(timestamp)
+        if parsed is None:
+            if len(memo) >= self.memoize:
+                memo.clear()
+            parsed = memo[timestamp] = self.parse(timestamp)
+        return parsed
+
+    def _outputs(self):
+        return [(index, column) for index, column in
+                enumerate([self.microseconds_column, self.weekday_column,
+                           self.hour_column]) if column is not None]
+
+    def map_row(self, row: Row) -> Optional[Row]:
+        parsed = self._parse(row[self.column])
+        for index, column in self._outputs():
+            row[column] = parsed[index]
+        return row
+
+    def map_batch(self, batch):
+        parsed = [self._parse(timestamp) for timestamp in batch[self.column]]
+        for index, column in self._outputs():
+            batch = batch.with_column(column,
+                                      [values[index] for values in parsed])
+        return batch
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        outputs = {column for _, column in self._outputs()}
+        return _ordering_prefix(input_ordering,
+                                lambda column: column not in outputs)
 
 
 class Read:
@@ -311,29 +1569,84 @@ class Read:
 
 
 class ReadFromFile:
-    """Reads from file using given parser"""
-    def __init__(self, parse_function):
+    """Reads from file using given parser. Lines are read in blocks; when
+    the parser is 'json.loads' whole block is decoded in a single call
+    (by orjson if it is installed) and blank lines are skipped"""
+    def __init__(self, parse_function, block_size: int = 1 << 20,
+                 fields: Sequence[str] = None):
+        """
+        :param parse_function: parser from string to Row
+        :param block_size: approximate number of bytes read at once
+        :param fields: columns to keep in parsed rows, all if not passed
+        """
         self.parse_function = parse_function
+        self.block_size = block_size
+        self.fields = fields
+
+    def _parse_json_lines(self, lines: List[str]) -> List[Row]:
+        lines = [line for line in lines if not line.isspace()]
+        document = '[' + ','.join(lines) + ']'
+        try:
+            rows = orjson.loads(document) if orjson is not None \
+                else json.loads(document)
+            if len(rows) == len(lines):
+                return rows
+        except ValueError:
+            pass
+        # let the parser report the malformed line
+        return [json.loads(line) for line in lines]
+
+    def parse_lines(self, lines: List[str]) -> List[Row]:
+        """Rows parsed from lines"""
+        if self.parse_function is json.loads:
+            rows = self._parse_json_lines(lines)
+        else:
+            rows = [self.parse_function(line) for line in lines]
+        if self.fields is None:
+            return rows
+        return [{key: row[key] for key in self.fields if key in row}
+                for row in rows]
 
     def __call__(self, file_name) -> OperationResult:
-        with open(file_name) as f:
-            for line in f:
-                yield self.parse_function(line)
+        with open(file_name, buffering=self.block_size) as f:
+            while True:
+                lines = f.readlines(self.block_size)
+                if not lines:
+                    return
+                yield from self.parse_lines(lines)
 
 
-class Project(Mapper):
+class Project(RowMapper):
     """Leave only mentioned columns"""
-    def __init__(self, columns: Sequence[str]):
+    def __init__(self, columns: Sequence[str], strict: bool = True):
         """
         :param columns: names of columns
+        :param strict: whether rows must have all of the columns; missing
+        columns are skipped otherwise
         """
         self.columns = columns
-
-    def __call__(self, row: Row) -> OperationResult:
+        self.strict = strict
+
+    def map_row(self, row: Row) -> Optional[Row]:
+        columns = self.columns if self.strict else \
+            [column for column in self.columns if column in row]
+        if isinstance(row, CompactRow):
+            return CompactRow(Schema(columns),
+                              tuple(row[column] for column in columns))
         new_row = {}
-        for column in self.columns:
+        for column in columns:
             new_row[column] = row[column]
-        yield new_row
+        return new_row
+
+    def map_batch(self, batch):
+        if self.strict:
+            return batch.select(self.columns)
+        return batch.select([column for column in self.columns
+                             if column in batch.columns])
+
+    def ordering(self, input_ordering: Ordering) -> Ordering:
+        return _ordering_prefix(input_ordering,
+                                lambda column: column in self.columns)
 
 
 # Reducers
@@ -341,6 +1654,8 @@ class Project(Mapper):
 
 class TopN(Reducer):
     """Return top N by value"""
+    streaming = True
+
     def __init__(self, column: str, n: int):
         """
         :param column: column name to get top by
@@ -351,11 +1666,9 @@ class TopN(Reducer):
 
     def __call__(self, group_key: Tuple[str],
                  rows: Iterable[Row])-> OperationResult:
-        sorted_rows = sorted(rows,
-                             key=lambda row: row[self.column_max],
-                             reverse=True)
-        sorted_rows = sorted_rows[:self.n]
-        yield from sorted_rows
+        # same as stable sort in descending order cut to n rows
+        yield from heapq.nlargest(self.n, rows,
+                                  key=itemgetter(self.column_max))
 
 
 class TermFrequency(Reducer):
@@ -386,7 +1699,7 @@ class TermFrequency(Reducer):
                 yield new_row
 
 
-class Count(Reducer):
+class Count(Aggregator):
     """Count rows passed and yield single row as a result"""
     def __init__(self, column: str):
         """
@@ -394,20 +1707,26 @@ class Count(Reducer):
         """
         self.column = column
 
-    def __call__(self, group_key: Tuple[str],
-                 rows: Iterable[Row]) -> OperationResult:
-        rows, rows_copy = tee(rows)
-        rows_size = 0
-        for _ in rows_copy:
-            rows_size += 1
-        for row in rows:
-            new_row = {key: row[key] for key in group_key}
-            new_row[self.column] = rows_size
-        yield new_row
+    def initial(self) -> int:
+        return 0
+
+    def update(self, state: int, row: Row) -> int:
+        return state + 1
+
+    def update_batch(self, state: int, batch) -> int:
+        return state + len(batch)
+
+    def merge(self, state: int, other: int) -> int:
+        return state + other
+
+    def result(self, state: int) -> int:
+        return state
 
 
 class RowsCounter(Reducer):
     """Count rows and save number to result column"""
+    streaming = True
+
     def __init__(self, column: str):
         """
         :param column: name of column to count
@@ -416,17 +1735,26 @@ class RowsCounter(Reducer):
 
     def __call__(self, group_key: Tuple[str],
                  rows: Iterable[Row]) -> OperationResult:
-        rows, rows_copy = tee(rows)
+        # only runs of equal keys are kept: a single one for a group of
+        # Reduce, one per run of rows with equal keys for CountAll
+        get_key = key_extractor(group_key, as_tuple=True)
+        runs = []  # type: List[List]
         rows_size = 0
-        for _ in rows_copy:
-            rows_size += 1
         for row in rows:
-            new_row = {key: row[key] for key in group_key}
-            new_row[self.column] = rows_size
-            yield new_row
+            key = get_key(row)
+            if runs and runs[-1][0] == key:
+                runs[-1][1] += 1
+            else:
+                runs.append([key, 1])
+            rows_size += 1
+        for key, run_size in runs:
+            for _ in range(run_size):
+                new_row = dict(zip(group_key, key))
+                new_row[self.column] = rows_size
+                yield new_row
 
 
-class Sum(Reducer):
+class Sum(Aggregator):
     """Sum values in column passed and yield single row as a result"""
     def __init__(self, column: str):
         """
@@ -434,19 +1762,23 @@ class Sum(Reducer):
         """
         self.column = column
 
-    def __call__(self, group_key: Tuple[str],
-                 rows: Iterable[Row]) -> OperationResult:
-        total_sum = 0
-        for row in rows:
-            total_sum += row[self.column]
-        for row in rows:
-            new_row = {key: row[key] for key in group_key}
-            new_row[self.column] = total_sum
-            yield new_row
-            break
+    def initial(self) -> Any:
+        return 0
+
+    def update(self, state: Any, row: Row) -> Any:
+        return state + row[self.column]
+
+    def update_batch(self, state: Any, batch) -> Any:
+        return state + _column_sum(batch[self.column])
 
+    def merge(self, state: Any, other: Any) -> Any:
+        return state + other
 
-class Average(Reducer):
+    def result(self, state: Any) -> Any:
+        return state
+
+
+class Average(Aggregator):
     """Returns average for the group"""
 
     def __init__(self, column: str):
@@ -455,19 +1787,26 @@ class Average(Reducer):
         """
         self.column = column
 
-    def __call__(self, group_key: Tuple[str],
-                 rows: Iterable[Row]) -> OperationResult:
-        total_sum = 0
-        rows, rows_copy = tee(rows)
-        rows_size = 0
-        for row in rows_copy:
-            total_sum += row[self.column]
-            rows_size += 1
-        for row in rows:
-            new_row = {key: row[key] for key in group_key}
-            new_row[self.column] = float(total_sum / rows_size)
-            yield new_row
-            break
+    def initial(self) -> Tuple[Any, int]:
+        return 0, 0
+
+    def update(self, state: Tuple[Any, int], row: Row) -> Tuple[Any, int]:
+        total_sum, rows_size = state
+        return total_sum + row[self.column], rows_size + 1
+
+    def update_batch(self, state: Tuple[Any, int],
+                     batch) -> Tuple[Any, int]:
+        total_sum, rows_size = state
+        return total_sum + _column_sum(batch[self.column]), \
+            rows_size + len(batch)
+
+    def merge(self, state: Tuple[Any, int],
+              other: Tuple[Any, int]) -> Tuple[Any, int]:
+        return state[0] + other[0], state[1] + other[1]
+
+    def result(self, state: Tuple[Any, int]) -> float:
+        total_sum, rows_size = state
+        return float(total_sum / rows_size)
 
 # Joiners
 
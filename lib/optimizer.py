@@ -0,0 +1,273 @@
+"""Rule-based rewriting of computational graphs before execution"""
+from typing import Dict, List
+
+from .operations import Map, Sort, Join, Filter, Project, FusedMap
+from .parallel import ParallelReduce
+
+
+def nodes(graph) -> List:
+    """All nodes of the graph in depth-first order, each node once"""
+    seen = set()
+    order = []
+
+    def visit(node):
+        if id(node) in seen:
+            return
+        seen.add(id(node))
+        order.append(node)
+        for parent in node.parents:
+            visit(parent)
+
+    visit(graph)
+    return order
+
+
+def count_consumers(graph) -> Dict[int, int]:
+    """Number of nodes reading output of every node, keyed by id of node"""
+    consumers = {}
+    for node in nodes(graph):
+        for parent in node.parents:
+            consumers[id(parent)] = consumers.get(id(parent), 0) + 1
+    return consumers
+
+
+def _mapper(node):
+    """Mapper of the node if it is a map node, None otherwise"""
+    if isinstance(node.operation, Map):
+        return node.operation.mapper
+    return None
+
+
+# Rules take node and consumer counts and return replacement node or None
+
+
+def remove_redundant_sort(node, consumers):
+    """Sort of rows which are already ordered by its keys does nothing"""
+    if isinstance(node.operation, Sort) and node.operation.is_redundant():
+        return node.parents[0]
+    return None
+
+
+def remove_sort_before_sort(node, consumers):
+    """Sort by columns which are all sorted by later does nothing: rows equal
+    by later keys keep their relative order. Parallel reduce sorts rows
+    by its keys itself"""
+    if not isinstance(node.operation, (Sort, ParallelReduce)):
+        return None
+    parent = node.parents[0]
+    if isinstance(parent.operation, Sort) \
+            and consumers[id(parent)] == 1 \
+            and set(parent.operation.keys) <= set(node.operation.keys):
+        return node.with_parents(parent.parents)
+    return None
+
+
+def push_filter_below_sort(node, consumers):
+    """Filter before sorting to sort fewer rows"""
+    mapper = _mapper(node)
+    parent = node.parents[0]
+    if isinstance(mapper, Filter) and isinstance(parent.operation, Sort) \
+            and consumers[id(parent)] == 1:
+        return parent.with_parents([node.with_parents(parent.parents)])
+    return None
+
+
+def push_filter_below_join(node, consumers):
+    """Filter only by join keys is applied to both inputs of the join.
+    Keys of rows of custom joiners may differ from keys of their inputs"""
+    mapper = _mapper(node)
+    parent = node.parents[0]
+    if isinstance(mapper, Filter) and mapper.columns is not None \
+            and isinstance(parent.operation, Join) \
+            and parent.operation.merges_rows() \
+            and consumers[id(parent)] == 1 \
+            and set(mapper.columns) <= set(parent.operation.keys):
+        return parent.with_parents([node.with_parents([grandparent])
+                                    for grandparent in parent.parents])
+    return None
+
+
+def push_project_below_sort(node, consumers):
+    """Drop unused columns before sorting to keep less data in memory"""
+    mapper = _mapper(node)
+    parent = node.parents[0]
+    if isinstance(mapper, Project) and isinstance(parent.operation, Sort) \
+            and consumers[id(parent)] == 1 \
+            and set(parent.operation.keys) <= set(mapper.columns):
+        return parent.with_parents([node.with_parents(parent.parents)])
+    return None
+
+
+def _is_projected(node, columns) -> bool:
+    """Whether rows of the node have only given columns: they are
+    projected to them, maybe before sorts and filters moved below"""
+    while isinstance(node.operation, Sort) or \
+            isinstance(_mapper(node), Filter):
+        node = node.parents[0]
+    mapper = _mapper(node)
+    return isinstance(mapper, Project) and set(mapper.columns) <= set(columns)
+
+
+def push_project_below_join(node, consumers):
+    """Drop columns which the projection after the join doesn't keep from
+    both inputs of the join. Join keys are kept, and so are columns which
+    the join renames with suffixes, on both sides, so that the names stay
+    the same. Only a projection right after the join is moved: columns read
+    by mappers in between are unknown, and so are columns read by custom
+    joiners"""
+    mapper = _mapper(node)
+    parent = node.parents[0]
+    if not isinstance(mapper, Project) \
+            or not isinstance(parent.operation, Join) \
+            or not parent.operation.merges_rows() \
+            or consumers[id(parent)] != 1:
+        return None
+    columns = list(parent.operation.keys)
+    for column in mapper.columns:
+        columns.append(column)
+        for suffix in parent.operation.joiner.suffixes:
+            if suffix and column.endswith(suffix):
+                columns.append(column[:-len(suffix)])
+    columns = list(dict.fromkeys(columns))
+    if all(_is_projected(grandparent, columns)
+           for grandparent in parent.parents):
+        return None
+    pruned = [grandparent.map(Project(columns, strict=False))
+              for grandparent in parent.parents]
+    return node.with_parents([parent.with_parents(pruned)])
+
+
+def merge_projects(node, consumers):
+    """Projection of projection is a single projection"""
+    mapper = _mapper(node)
+    parent = node.parents[0]
+    parent_mapper = _mapper(parent)
+    if isinstance(mapper, Project) and isinstance(parent_mapper, Project) \
+            and consumers[id(parent)] == 1 \
+            and (mapper.strict or not parent_mapper.strict) \
+            and set(mapper.columns) <= set(parent_mapper.columns):
+        return node.with_parents(parent.parents)
+    return None
+
+
+def _mappers(node):
+    """Mappers applied by the node in turn if it is a map node"""
+    if isinstance(node.operation, Map):
+        return [node.operation.mapper]
+    if isinstance(node.operation, FusedMap):
+        return node.operation.mappers
+    return None
+
+
+def merge_maps(node, consumers):
+    """Adjacent map nodes become one fused map applying mappers in turn"""
+    mappers = _mappers(node)
+    parent = node.parents[0]
+    parent_mappers = _mappers(parent)
+    if mappers is None or parent_mappers is None \
+            or consumers[id(parent)] != 1:
+        return None
+    return node.with_parents(parent.parents,
+                             operation=FusedMap(parent_mappers + mappers))
+
+
+# Rules of the same stage are applied until none of them matches.
+# Maps are merged last so that filters and projections can still be moved
+RULE_STAGES = [
+    [remove_redundant_sort, remove_sort_before_sort,
+     push_filter_below_sort, push_filter_below_join,
+     push_project_below_sort, push_project_below_join, merge_projects],
+    [merge_maps],
+]
+
+
+def _replace(node, target, replacement, memo):
+    """Copy of the graph where target node is substituted by replacement"""
+    if node is target:
+        return replacement
+    if id(node) not in memo:
+        parents = [_replace(parent, target, replacement, memo)
+                   for parent in node.parents]
+        if all(new is old for new, old in zip(parents, node.parents)):
+            memo[id(node)] = node
+        else:
+            memo[id(node)] = node.with_parents(parents)
+    return memo[id(node)]
+
+
+def _rewrite_once(graph, rules):
+    """Apply the first matching rule; None if no rule matches"""
+    consumers = count_consumers(graph)
+    for node in nodes(graph):
+        if node.operation is None:
+            continue
+        for rule in rules:
+            replacement = rule(node, consumers)
+            if replacement is not None:
+                return _replace(graph, node, replacement, {})
+    return None
+
+
+def optimize(graph):
+    """Rewrite the graph into an equivalent one which is cheaper to run"""
+    for rules in RULE_STAGES:
+        while True:
+            rewritten = _rewrite_once(graph, rules)
+            if rewritten is None:
+                break
+            graph = rewritten
+    return graph
+
+
+def limit_memory(graph, memory_limit: int):
+    """Copy of the graph where operations buffering rows and results shared
+    by several consumers split memory_limit equally
+    :return: the graph and memory limit of every shared result
+    """
+    consumers = count_consumers(graph)
+    graph_nodes = nodes(graph)
+    buffering = sum(1 for node in graph_nodes if node.operation is not None
+                    and node.operation.buffers_rows)
+    shared = sum(1 for node in graph_nodes if consumers.get(id(node), 0) > 1)
+    share = memory_limit // max(buffering + shared, 1)
+    memo = {}
+
+    def rebuild(node):
+        if id(node) not in memo:
+            if node.operation is None:
+                memo[id(node)] = node
+            else:
+                memo[id(node)] = node.with_parents(
+                    [rebuild(parent) for parent in node.parents],
+                    node.operation.with_memory_limit(share))
+        return memo[id(node)]
+
+    return rebuild(graph), share
+
+
+def format_plan(graph) -> str:
+    """Tree of graph nodes; nodes shared by several consumers are numbered
+    and printed only once"""
+    consumers = count_consumers(graph)
+    numbers = {}
+    lines = []
+
+    def visit(node, depth):
+        indent = '  ' * depth
+        if id(node) in numbers:
+            lines.append('{}-> #{}'.format(indent, numbers[id(node)]))
+            return
+        label = repr(node.operation) if node.operation is not None \
+            else 'Read({!r})'.format(node.data_source)
+        if node.ordering:
+            label += ' ordered by {}'.format(', '.join(node.ordering))
+        if consumers.get(id(node), 0) > 1:
+            numbers[id(node)] = len(numbers) + 1
+            label = '#{} {}'.format(numbers[id(node)], label)
+        lines.append(indent + label)
+        if node.operation is not None:
+            for parent in node.parents:
+                visit(parent, depth + 1)
+
+    visit(graph, 0)
+    return '\n'.join(lines)
@@ -0,0 +1,263 @@
+"""Operations which distribute work over a pool of worker processes.
+
+Workers are forked where the platform allows it, so mappers and reducers
+(including closures and lambdas defined inside graph constructors) are
+inherited by workers instead of being pickled. With other start methods
+they must be picklable, e.g. defined at module level. Rows are always
+pickled on their way to and from workers.
+"""
+from collections import deque
+import heapq
+from functools import partial
+import io
+from itertools import islice
+import multiprocessing
+import os
+import pickle
+import queue
+from typing import Iterable, Callable, List, Sequence, Dict, Tuple
+
+from .operations import Row, OperationResult, Operation, Ordering, Mapper, \
+    Reducer, Reduce, Sort, Aggregator, HashAggregate, ReadFromFile, \
+    key_extractor
+
+
+_task = None
+
+
+def _init_worker(task: Callable) -> None:
+    global _task
+    _task = task
+
+
+def _run_task(chunk):
+    return _task(chunk)
+
+
+def _context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def make_pool(workers: int, task: Callable):
+    """Pool of workers each of which runs task on chunks sent by 'run_chunks'
+    """
+    context = _context()
+    if context.get_start_method() != 'fork':
+        try:
+            pickle.dumps(task)
+        except (pickle.PicklingError, AttributeError, TypeError) as error:
+            raise ValueError('{!r} cannot be sent to worker processes; '
+                             'define it at module level'
+                             .format(task)) from error
+    return context.Pool(workers, initializer=_init_worker, initargs=(task,))
+
+
+def chunked(rows: Iterable[Row], chunk_size: int) -> Iterable[List[Row]]:
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_chunks(pool, chunks: Iterable, window: int, ordered: bool = True):
+    """Send chunks to the pool keeping at most window of them in flight;
+    yield results in order of chunks or in order of completion"""
+    if ordered:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_run_task, (chunk,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        return
+
+    completed = queue.Queue()
+    in_flight = 0
+
+    def receive():
+        is_error, result = completed.get()
+        if is_error:
+            raise result
+        return result
+
+    def on_result(result):
+        completed.put((False, result))
+
+    def on_error(error):
+        completed.put((True, error))
+
+    for chunk in chunks:
+        pool.apply_async(_run_task, (chunk,),
+                         callback=on_result, error_callback=on_error)
+        in_flight += 1
+        if in_flight >= window:
+            yield receive()
+            in_flight -= 1
+    for _ in range(in_flight):
+        yield receive()
+
+
+def _map_chunk(mapper: Mapper, chunk: List[Row]) -> List[Row]:
+    return [new_row for row in chunk for new_row in mapper.apply(row)]
+
+
+class ParallelMap(Operation):
+    """Map with mapper applied to chunks of rows in worker processes"""
+    def __init__(self, mapper: Mapper, workers: int, ordered: bool = True,
+                 chunk_size: int = 1000):
+        """
+        :param mapper: mapper to use
+        :param workers: number of worker processes
+        :param ordered: keep order of rows; otherwise chunks are yielded
+        as soon as they are processed
+        :param chunk_size: number of rows sent to a worker at once
+        """
+        self.mapper = mapper
+        self.workers = workers
+        self.ordered = ordered
+        self.chunk_size = chunk_size
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        if not self.ordered:
+            return ()
+        return self.mapper.ordering(input_orderings[0])
+
+    def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
+        with make_pool(self.workers,
+                       partial(_map_chunk, self.mapper)) as pool:
+            for mapped in run_chunks(pool, chunked(rows, self.chunk_size),
+                                     window=2 * self.workers,
+                                     ordered=self.ordered):
+                yield from mapped
+
+
+def _reduce_partition(reducer: Reducer, keys: Sequence[str],
+                      partition: List[Row]) -> List[Row]:
+    return list(Reduce(reducer, keys)(Sort(keys)(partition)))
+
+
+class ParallelReduce(Operation):
+    """Reduce which hash-partitions rows by keys and sorts and reduces every
+    partition in its own worker process. Groups are formed over the whole
+    input, so it doesn't need to be sorted; output is ordered by keys"""
+    def __init__(self, reducer: Reducer, keys: Sequence[str], workers: int):
+        """
+        :param reducer: reducer to use
+        :param keys: keys for grouping
+        :param workers: number of worker processes and partitions
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self.workers = workers
+
+    def ordering(self, *input_orderings: Ordering) -> Ordering:
+        return tuple(self.keys)
+
+    def _partition(self, rows: Iterable[Row], key) -> List[List[Row]]:
+        partitions = [[] for _ in range(self.workers)]
+        for row in rows:
+            partitions[hash(key(row)) % self.workers].append(row)
+        return partitions
+
+    def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
+        key = key_extractor(self.keys)
+        partitions = self._partition(rows, key)
+        with make_pool(self.workers,
+                       partial(_reduce_partition, self.reducer,
+                               self.keys)) as pool:
+            reduced = list(run_chunks(pool, partitions, window=self.workers))
+        # every partition is ordered by keys and keys of different
+        # partitions never coincide
+        yield from heapq.merge(*reduced, key=key)
+
+
+def _aggregate_chunk(aggregate: HashAggregate,
+                     chunk: List[Row]) -> Dict[tuple, list]:
+    return aggregate.partial_states(chunk)
+
+
+class ParallelAggregate(HashAggregate):
+    """Hash aggregation where worker processes combine chunks of rows into
+    partial states which are merged afterwards"""
+    def __init__(self, aggregators: Sequence[Aggregator], keys: Sequence[str],
+                 workers: int, chunk_size: int = 10000):
+        """
+        :param aggregators: aggregators to compute, each yields own column
+        :param keys: keys for grouping
+        :param workers: number of worker processes
+        :param chunk_size: number of rows sent to a worker at once
+        """
+        super().__init__(aggregators, keys)
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+    def __call__(self, rows: Iterable[Row], *args) -> OperationResult:
+        states = {}
+        with make_pool(self.workers,
+                       partial(_aggregate_chunk,
+                               HashAggregate(self.aggregators,
+                                             self.keys))) as pool:
+            for chunk_states in run_chunks(pool,
+                                           chunked(rows, self.chunk_size),
+                                           window=2 * self.workers):
+                self.merge_states(states, chunk_states)
+        yield from self.results(states)
+
+
+def byte_ranges(file_name: str, shard_size: int) -> List[Tuple[int, int]]:
+    """Split file into ranges of at least shard_size bytes (except the last
+    one) which start and end at line boundaries"""
+    size = os.path.getsize(file_name)
+    ranges = []
+    with open(file_name, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(start + shard_size - 1)
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _read_range(reader: ReadFromFile, file_name: str,
+                byte_range: Tuple[int, int]) -> List[Row]:
+    start, end = byte_range
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # decode lines exactly like a file opened in text mode
+    return reader.parse_lines(io.TextIOWrapper(io.BytesIO(data)).readlines())
+
+
+class ParallelReadFromFile:
+    """Reads file split into line-aligned byte ranges, every range is
+    parsed in a worker process"""
+    def __init__(self, parse_function, workers: int, ordered: bool = True,
+                 fields: Sequence[str] = None, shard_size: int = 1 << 24):
+        """
+        :param parse_function: parser from string to Row
+        :param workers: number of worker processes
+        :param ordered: keep order of rows of the file; otherwise ranges
+        are yielded as soon as they are parsed
+        :param fields: columns to keep in parsed rows, all if not passed
+        :param shard_size: approximate number of bytes parsed by a worker
+        at once
+        """
+        self.reader = ReadFromFile(parse_function, fields=fields)
+        self.workers = workers
+        self.ordered = ordered
+        self.shard_size = shard_size
+
+    def __call__(self, file_name) -> OperationResult:
+        ranges = byte_ranges(file_name, self.shard_size)
+        with make_pool(self.workers,
+                       partial(_read_range, self.reader, file_name)) as pool:
+            for rows in run_chunks(pool, ranges, window=2 * self.workers,
+                                   ordered=self.ordered):
+                yield from rows
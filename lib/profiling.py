@@ -0,0 +1,115 @@
+"""Per-node execution statistics collected by 'Graph.run(profile=True)'.
+
+Time is wall-clock time measured around every request of a row from a node;
+time spent in nodes upstream of it is subtracted, so self time of a node is
+the time of its own operation (including waiting for its worker processes).
+"""
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Iterator, List
+
+from .operations import Row
+from .optimizer import nodes
+
+
+class NodeStats:
+    """Statistics of a single graph node"""
+    def __init__(self, label: str):
+        """
+        :param label: description of the node
+        """
+        self.label = label
+        self.rows_in = 0
+        self.rows_out = 0
+        self.total_time = 0.0
+        self.upstream_time = 0.0
+
+    @property
+    def self_time(self) -> float:
+        return self.total_time - self.upstream_time
+
+    @property
+    def throughput(self) -> float:
+        """Output rows per second of self time"""
+        if self.self_time <= 0:
+            return 0.0
+        return self.rows_out / self.self_time
+
+
+def node_label(node) -> str:
+    if node.operation is not None:
+        return repr(node.operation)
+    if node.reader is not None:
+        return 'ReadFromFile({!r})'.format(node.data_source)
+    return 'Read({!r})'.format(node.data_source)
+
+
+class Profiler:
+    """Collects statistics of nodes whose outputs and inputs it wraps"""
+    def __init__(self):
+        self.stats = {}  # type: Dict[int, NodeStats]
+        # time spent upstream during every request in progress
+        self._upstream = []  # type: List[float]
+
+    def _node_stats(self, node) -> NodeStats:
+        stats = self.stats.get(id(node))
+        if stats is None:
+            stats = self.stats[id(node)] = NodeStats(node_label(node))
+        return stats
+
+    def outputs(self, node, compute: Callable[[], Iterable[Row]]) \
+            -> Callable[[], Iterable[Row]]:
+        """Function computing rows of the node which measures them"""
+        stats = self._node_stats(node)
+        return lambda: self._timed(stats, compute)
+
+    def inputs(self, node, rows: Iterable[Row]) -> Iterator[Row]:
+        """Rows read by the node from one of its parents"""
+        stats = self._node_stats(node)
+        for row in rows:
+            stats.rows_in += 1
+            yield row
+
+    def _timed(self, stats: NodeStats,
+               compute: Callable[[], Iterable[Row]]) -> Iterator[Row]:
+        upstream = self._upstream
+        upstream.append(0.0)
+        start = perf_counter()
+        try:
+            iterator = iter(compute())
+        finally:
+            self._account(stats, start)
+        while True:
+            upstream.append(0.0)
+            start = perf_counter()
+            try:
+                row = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._account(stats, start)
+            stats.rows_out += 1
+            yield row
+
+    def _account(self, stats: NodeStats, start: float) -> None:
+        elapsed = perf_counter() - start
+        stats.total_time += elapsed
+        stats.upstream_time += self._upstream.pop()
+        if self._upstream:
+            self._upstream[-1] += elapsed
+
+    def report(self, graph=None) -> str:
+        """Table of statistics of nodes, in order of the plan of graph
+        if it is passed"""
+        if graph is not None:
+            stats = [self.stats[id(node)] for node in nodes(graph)
+                     if id(node) in self.stats]
+        else:
+            stats = list(self.stats.values())
+        lines = ['{:>10} {:>10} {:>9} {:>12}  {}'.format(
+            'rows in', 'rows out', 'self, s', 'rows/s', 'node')]
+        for node_stats in stats:
+            lines.append('{:>10} {:>10} {:>9.3f} {:>12.0f}  {}'.format(
+                node_stats.rows_in, node_stats.rows_out,
+                node_stats.self_time, node_stats.throughput,
+                node_stats.label))
+        return '\n'.join(lines)
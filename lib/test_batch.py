@@ -0,0 +1,117 @@
+from pytest import approx, raises
+
+from .batch import Batch, ToBatches, ToRows, BatchMap, BatchSort, \
+    BatchReduce, BatchJoin
+from .graph import Graph
+from .operations import Sort, Reduce, Join, Count, Sum, FirstReducer, \
+    InnerJoiner, OuterJoiner, Filter, Project, Split, LowerCase, FusedMap, \
+    Haversine, Divide, Product, Idf
+
+
+def test_batch_round_trip():
+    rows = [{'id': i, 'value': i / 2, 'text': str(i)} for i in range(10)]
+    rows.append({'id': 10, 'text': 'other columns'})
+
+    batches = list(ToBatches(batch_size=4)(rows))
+
+    assert [len(batch) for batch in batches] == [4, 4, 2, 1]
+    assert list(ToRows()(batches)) == rows
+    assert Batch.from_rows(rows[:3]).take([2, 0]).select(['text']) \
+        .key_tuples(['text']) == [('2',), ('0',)]
+
+    rows = [{'v': 2}, {'v': 1.5}]
+    batches = list(ToBatches(batch_size=1)(rows))
+    result = list(ToRows()([Batch.concat(batches)]))
+    assert rows == result
+    assert [int, float] == [type(row['v']) for row in result]
+
+
+def test_batch_operations_agree_with_rows():
+    rows = [{'doc_id': i % 3, 'word': word, 'n': i}
+            for i, word in enumerate('b a c a b a d c'.split() * 5)]
+    keys = ['word', 'doc_id']
+
+    sort_etalon = list(Sort(keys)(rows))
+    sorted_batches = list(BatchSort(keys, batch_size=7)(
+        ToBatches(batch_size=5)(rows)))
+    assert list(ToRows()(sorted_batches)) == sort_etalon
+
+    for reducer in [Count('count'), Sum('n'), FirstReducer()]:
+        etalon = list(Reduce(reducer, keys)(sort_etalon))
+        result = BatchReduce(reducer, keys)(iter(sorted_batches))
+        assert list(ToRows()(result)) == etalon
+
+
+def _row_order(row):
+    return repr(sorted(row.items()))
+
+
+def test_batch_join():
+    left = [{'id': i % 4, 'value': i, 'name': 'a'} for i in range(10)]
+    right = [{'id': i, 'value': -i} for i in range(2, 6)]
+
+    for joiner in [InnerJoiner(), OuterJoiner()]:
+        etalon = list(Join(joiner, ['id'])(left, right))
+        result = BatchJoin(joiner, ['id'])(ToBatches(3)(left),
+                                           ToBatches(3)(right))
+        assert sorted(etalon, key=_row_order) == \
+            sorted(ToRows()(result), key=_row_order)
+
+
+def test_batched_graph():
+    docs = [{'doc_id': i, 'text': 'Hello little world hello'}
+            for i in range(20)]
+
+    def word_count(graph):
+        return graph.map(Split('text')).map(LowerCase('text')) \
+            .map(Filter(lambda row: row['text'] != 'little')) \
+            .map(Project(['text'])) \
+            .sort(['text']).reduce(Count('count'), ['text'])
+
+    etalon = word_count(Graph().read_from_iter('docs')).run(docs=docs)
+    graph = word_count(Graph().read_from_iter('docs').to_batches(8))
+
+    assert graph.is_batched
+    assert graph.run(docs=docs) == etalon
+
+
+def test_column_arithmetic():
+    rows = [{'start': [37.84 + i / 100, 55.73], 'end': [37.85, 55.74 - i / 50],
+             'a': i + 1, 'b': 2 * i + 3} for i in range(10)]
+    mappers = [Haversine('start', 'end', 'distance'), Divide('a', 'b', 'c'),
+               Product(['a', 'b', 'c'], 'p'), Idf('a', 'b', 'idf')]
+
+    etalon = list(FusedMap(mappers)(dict(row) for row in rows))
+
+    batches = ToBatches(batch_size=4)(rows)
+    for mapper in mappers:
+        batches = BatchMap(mapper)(batches)
+    result = list(ToRows()(batches))
+
+    assert len(etalon) == len(result)
+    for etalon_row, row in zip(etalon, result):
+        assert row == {key: approx(value)
+                       for key, value in etalon_row.items()}
+
+    rows = [{'a': 1, 'b': 2}, {'a': 1, 'b': 0}]
+    with raises(ZeroDivisionError):
+        list(FusedMap([Divide('a', 'b', 'c')])(rows))
+    with raises(ZeroDivisionError):
+        list(BatchMap(Divide('a', 'b', 'c'))(ToBatches()(rows)))
+
+    rows = [{'a': 1, 'b': 2}, {'a': 0, 'b': 2}]
+    with raises(ZeroDivisionError):
+        list(FusedMap([Idf('a', 'b', 'c')])(rows))
+    with raises(ZeroDivisionError):
+        list(BatchMap(Idf('a', 'b', 'c'))(ToBatches()(rows)))
+    rows = [{'a': 1, 'b': 2}, {'a': 2, 'b': 0}]
+    with raises(ValueError):
+        list(FusedMap([Idf('a', 'b', 'c')])(rows))
+    with raises(ValueError):
+        list(BatchMap(Idf('a', 'b', 'c'))(ToBatches()(rows)))
+
+    rows = [{'v': 2 ** 62, 'w': 0.5}]
+    for mapper in [Product(['v', 'v'], 'p'), Product(['v', 'v', 'w'], 'p')]:
+        etalon = list(FusedMap([mapper])(dict(row) for row in rows))
+        result = list(ToRows()(BatchMap(mapper)(ToBatches()(rows))))
+        assert etalon == result
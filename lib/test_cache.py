@@ -0,0 +1,116 @@
+import json
+import os
+
+from .cache import SharedResult, ResultStore, node_fingerprints
+from .graph import Graph
+from .operations import Count, InnerJoiner, LowerCase, ParseTimestamp
+
+
+def test_shared_source_is_read_once():
+    docs = [
+        {'doc_id': 1, 'text': 'hello'},
+        {'doc_id': 1, 'text': 'world'},
+        {'doc_id': 2, 'text': 'hello'}
+    ]
+
+    etalon = [
+        {'doc_id': 1, 'text': 'hello', 'count': 2},
+        {'doc_id': 1, 'text': 'world', 'count': 2},
+        {'doc_id': 2, 'text': 'hello', 'count': 1}
+    ]
+
+    graph = Graph().read_from_iter('docs')
+    counts = graph.reduce(Count('count'), keys=['doc_id'])
+    graph = graph.join(InnerJoiner(), counts, keys=['doc_id'])
+
+    assert etalon == graph.run(docs=iter(docs))
+
+
+def test_shared_result_spills_and_evicts():
+    rows = [{'test_id': i, 'text': 'row number {}'.format(i)}
+            for i in range(100)]
+
+    shared = SharedResult(lambda: iter(rows), consumers=2, memory_limit=1000)
+
+    first = shared.read()
+    assert rows[0] == next(first)
+    assert shared.is_spilled
+    path = shared._path
+
+    assert rows == list(shared.read())
+    assert rows[1:] == list(first)
+    assert not os.path.exists(path)
+
+
+def test_shared_rows_are_not_changed_by_other_consumers(tmp_path):
+    input_path = tmp_path / 'docs.txt'
+    input_path.write_text('{"doc_id": 1, "text": "Hello World"}\n')
+
+    etalon = [{'doc_id': 1, 'text_1': 'hello world',
+               'text_2': 'Hello World'}]
+
+    graph = Graph().read_from_file('docs', json.loads)
+    graph = graph.map(LowerCase('text')) \
+        .join(InnerJoiner(), graph, keys=['doc_id'])
+
+    for memory_limit in [None, 10]:
+        assert etalon == graph.run(docs=str(input_path),
+                                   memory_limit=memory_limit)
+
+
+parsed_lines = []
+
+
+def parse_and_remember(line):
+    parsed_lines.append(line)
+    return json.loads(line)
+
+
+def test_result_store_serves_unchanged_graph(tmp_path):
+    input_path = tmp_path / 'docs.txt'
+    input_path.write_text('{"doc_id": 1, "text": "hello"}\n'
+                          '{"doc_id": 2, "text": "world"}\n'
+                          '{"doc_id": 3, "text": "hello"}\n')
+
+    graph = Graph().read_from_file('docs', parse_and_remember) \
+        .sort(['text']) \
+        .reduce(Count('count'), keys=['text'])
+
+    etalon = [{'text': 'hello', 'count': 2}, {'text': 'world', 'count': 1}]
+    cache_dir = str(tmp_path / 'cache')
+
+    del parsed_lines[:]
+    assert etalon == graph.run(docs=str(input_path), cache_dir=cache_dir)
+    assert 3 == len(parsed_lines)
+    assert etalon == graph.run(docs=str(input_path), cache_dir=cache_dir)
+    assert 3 == len(parsed_lines)
+
+    input_path.write_text('{"doc_id": 1, "text": "world"}\n')
+    assert [{'text': 'world', 'count': 1}] == \
+        graph.run(docs=str(input_path), cache_dir=cache_dir)
+    assert 4 == len(parsed_lines)
+
+
+def test_result_store_evicts_least_recently_used(tmp_path):
+    store = ResultStore(str(tmp_path), size_limit=1000)
+    rows = [{'test_id': i} for i in range(30)]
+
+    list(store.put('first', rows))
+    list(store.put('second', rows))
+    assert store.get('first') is None
+    assert rows == list(store.get('second'))
+
+
+def test_fingerprints_dont_change_after_run(tmp_path):
+    input_path = tmp_path / 'times.txt'
+    input_path.write_text('{"time": "20171020T112238.723000"}\n'
+                          '{"time": "20171020T112238.723000"}\n')
+    kwargs = {'times': str(input_path)}
+
+    graph = Graph().read_from_file('times', json.loads) \
+        .map(ParseTimestamp('time', hour_column='hour', memoize=10)) \
+        .sort(['hour'])
+
+    fingerprints = node_fingerprints(graph, kwargs)
+    graph.run(**kwargs)
+    assert fingerprints == node_fingerprints(graph, kwargs)
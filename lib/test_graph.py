@@ -0,0 +1,187 @@
+import json
+from operator import itemgetter
+
+from pytest import raises
+
+from .graph import Graph
+from .optimizer import optimize
+from .operations import Count, InnerJoiner, LowerCase, Filter, Split, \
+    Project, Sort, FusedMap, Join, Joiner
+
+
+def test_sort_ordering_propagation():
+    graph = Graph().read_from_iter('docs')
+    assert () == graph.ordering
+
+    graph = graph.sort(['doc_id', 'text'])
+    assert ('doc_id', 'text') == graph.ordering
+    assert ('doc_id', 'text') == graph.sort(['doc_id']).ordering
+    assert ('doc_id',) == graph.map(LowerCase('text')).ordering
+    assert ('doc_id', 'text') == \
+        graph.map(Filter(lambda row: True)).ordering
+    assert ('doc_id',) == \
+        graph.reduce(Count('count'), keys=['doc_id']).ordering
+    assert ('text',) == graph.sort(['text']).ordering
+
+
+def test_presorted_inputs_are_not_sorted_again():
+    docs = [
+        {'doc_id': 2, 'text': 'b'},
+        {'doc_id': 1, 'text': 'a'},
+        {'doc_id': 1, 'text': 'c'},
+    ]
+    lengths = [
+        {'doc_id': 1, 'length': 2},
+        {'doc_id': 2, 'length': 1},
+    ]
+
+    graph = Graph().read_from_iter('docs').sort(['doc_id'])
+    graph = graph.sort(['doc_id']) \
+        .join(InnerJoiner(), Graph().read_from_iter('lengths'),
+              keys=['doc_id'], strategy='sort')
+    assert ('doc_id',) == graph.ordering
+
+    etalon = [
+        {'doc_id': 1, 'text': 'a', 'length': 2},
+        {'doc_id': 1, 'text': 'c', 'length': 2},
+        {'doc_id': 2, 'text': 'b', 'length': 1},
+    ]
+
+    result = graph.run(docs=docs, lengths=lengths)
+
+    assert etalon == sorted(result, key=itemgetter('doc_id', 'text'))
+
+
+def test_join_output_is_sorted_by_keys_in_their_order():
+    left = [{'a': a, 'b': b} for a, b in [(2, 2), (1, 1), (2, 1), (1, 2)]]
+    right = [{'a': a, 'b': b, 'c': a * b}
+             for a, b in [(1, 2), (2, 1), (1, 1), (2, 2)]]
+
+    graph = Graph().read_from_iter('left').sort(['b', 'a']) \
+        .join(InnerJoiner(), Graph().read_from_iter('right'),
+              keys=['a', 'b'])
+    assert ('a', 'b') == graph.ordering
+
+    result = graph.run(left=left, right=right)
+    assert [(1, 1), (1, 2), (2, 1), (2, 2)] == [(row['a'], row['b'])
+                                                for row in result]
+
+
+def test_join_unknown_strategy():
+    docs = Graph().read_from_iter('docs')
+    for graph in [docs, docs.to_batches()]:
+        with raises(ValueError):
+            graph.join(InnerJoiner(), docs, keys=['doc_id'], strategy='hsah')
+
+
+def test_optimizer_removes_redundant_stages():
+    docs = [
+        {'doc_id': 1, 'text': 'hello, little world'},
+        {'doc_id': 2, 'text': 'little'},
+    ]
+
+    graph = Graph().read_from_iter('docs') \
+        .map(LowerCase('text')) \
+        .map(Split('text')) \
+        .sort(['text', 'doc_id']) \
+        .sort(['text']) \
+        .map(Filter(lambda row: row['text'] != 'little', columns=['text'])) \
+        .map(Project(['text']))
+
+    optimized = optimize(graph)
+    assert isinstance(optimized.operation.mapper, Project)
+    assert isinstance(optimized.parents[0].operation, Sort)
+    assert isinstance(optimized.parents[0].parents[0].operation, FusedMap)
+
+    etalon = [{'text': 'hello,'}, {'text': 'world'}]
+
+    assert etalon == graph.run(docs=docs, optimize=False)
+    assert etalon == graph.run(docs=docs)
+
+
+def test_optimizer_prunes_columns_below_join():
+    docs = [
+        {'doc_id': 1, 'text': 'hello', 'score': 1, 'extra': 'x'},
+        {'doc_id': 2, 'text': 'world', 'score': 2, 'extra': 'y'},
+    ]
+    lengths = [
+        {'doc_id': 1, 'length': 5, 'score': 3, 'other': 'z'},
+        {'doc_id': 2, 'length': 5, 'score': 4, 'other': 'w'},
+    ]
+
+    graph = Graph().read_from_iter('docs').sort(['doc_id']) \
+        .join(InnerJoiner(), Graph().read_from_iter('lengths')
+              .sort(['doc_id']), keys=['doc_id']) \
+        .map(Project(['text', 'score_2']))
+
+    optimized = optimize(graph)
+    join = optimized.parents[0]
+    for side in join.parents:
+        assert isinstance(side.operation, Sort)
+        assert isinstance(side.parents[0].operation.mapper, Project)
+
+    etalon = [{'text': 'hello', 'score_2': 3},
+              {'text': 'world', 'score_2': 4}]
+
+    assert etalon == graph.run(docs=docs, lengths=lengths, optimize=False)
+    assert etalon == graph.run(docs=docs, lengths=lengths)
+
+
+def test_optimizer_keeps_columns_of_custom_joiners():
+    class Score(Joiner):
+        def __call__(self, keys, rows_a, rows_b):
+            if rows_a is not None and rows_b is not None:
+                for row_a in rows_a:
+                    for row_b in rows_b:
+                        yield {'k': row_a['k'],
+                               'score': row_a['w'] * 10 + row_b['w']}
+
+    left = [{'k': 1, 'w': 1}, {'k': 2, 'w': 2}]
+    right = [{'k': 1, 'w': 0}, {'k': 2, 'w': 1}]
+    joined = Graph().read_from_iter('left') \
+        .join(Score(), Graph().read_from_iter('right'), keys=['k'])
+
+    graph = joined.map(Project(['k', 'score']))
+    etalon = [{'k': 1, 'score': 10}, {'k': 2, 'score': 21}]
+    assert etalon == graph.run(left=left, right=right, optimize=False)
+    assert etalon == graph.run(left=left, right=right)
+
+    graph = joined.map(Filter(lambda row: row['k'] > 1, columns=['k']))
+    assert isinstance(optimize(graph).parents[0].operation, Join)
+    assert etalon[1:] == graph.run(left=left, right=right)
+
+
+def test_run_to_file(tmp_path):
+    docs = [{'doc_id': i, 'text': 'a b c'} for i in range(5)]
+    graph = Graph().read_from_iter('docs').map(Split('text'))
+
+    result = graph.run_iter(docs=iter(docs))
+    assert next(result) == {'doc_id': 0, 'text': 'a'}
+    assert len(list(result)) == 14
+
+    path = tmp_path / 'result.jsonl'
+    assert graph.run_to_file(str(path), docs=docs) == 15
+    rows = [json.loads(line) for line in path.read_text().splitlines()]
+    assert rows == graph.run(docs=docs)
+
+    path = tmp_path / 'result.json'
+    graph.run_to_file(str(path), format='json', docs=docs)
+    assert json.loads(path.read_text()) == rows
+
+    for name in ['format', 'profile']:
+        with raises(ValueError):
+            Graph().read_from_iter(name)
+        with raises(ValueError):
+            Graph().read_from_file(name, json.loads)
+
+
+def test_run_memory_limit():
+    docs = [{'doc_id': i, 'text': 'hello little world ' * (i % 5 + 1)}
+            for i in range(50)]
+    words = Graph().read_from_iter('docs').map(Split('text'))
+    counts = words.sort(['doc_id']).reduce(Count('count'), ['doc_id'])
+    graph = words.sort(['doc_id', 'text']) \
+        .join(InnerJoiner(), counts, ['doc_id']) \
+        .sort(['text', 'doc_id'])
+
+    assert graph.run(docs=docs, memory_limit=5000) == graph.run(docs=docs)
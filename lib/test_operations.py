@@ -1,11 +1,18 @@
+import json
 from operator import itemgetter
+import pickle
 
-from pytest import approx
+from pytest import approx, raises
 
+from . import operations
 from .operations import (
-    Map, DummyMapper, LowerCase, FilterPunctuation, Split, Product, Filter, Project,
-    Reduce, FirstReducer, TopN, TermFrequency, Count, Sum,
-    Sort, Join, LeftJoiner, RightJoiner, InnerJoiner, OuterJoiner
+    Map, FusedMap, Mapper, DummyMapper, LowerCase, FilterPunctuation, Split,
+    Product, Filter, Project,
+    Reducer, Reduce, FirstReducer, TopN, TermFrequency, Count, Sum, Average,
+    HashAggregate, ParseTimestamp, ReadFromFile, CountAll, RowsCounter,
+    Compact, CompactRow, ApplyFunction, TopK, key_extractor,
+    Sort, Join, JoinStats, Joiner, LeftJoiner, RightJoiner, InnerJoiner,
+    OuterJoiner
 )
 
 
@@ -343,6 +350,20 @@ def test_complex_sort():
     assert etalon == list(result)
 
 
+def test_external_sort():
+    matches = [
+        {'match_id': match_id, 'player_id': player_id,
+         'score': (match_id * 7 + player_id * 13) % 10}
+        for match_id in range(5) for player_id in range(20)
+    ]
+
+    etalon = sorted(matches, key=itemgetter('score', 'match_id'))
+
+    result = Sort(keys=['score', 'match_id'], memory_limit=2000)(matches)
+
+    assert etalon == list(result)
+
+
 def test_simple_join():
     players = [
         {'player_id': 1, 'username': 'XeroX'},
@@ -508,3 +529,382 @@ def test_simple_join_with_collision():
                   keys=['player_id'])(presorted_games, presorted_players)
 
     assert etalon == sorted(result, key=itemgetter('game_id'))
+
+
+def test_join_strategies_agree():
+    players = [
+        {'player_id': 0, 'username': 'root'},
+        {'player_id': 1, 'username': 'XeroX'},
+        {'player_id': 2, 'username': 'jay'}
+    ]
+
+    games = [
+        {'game_id': 1, 'player_id': 3, 'score': 0},
+        {'game_id': 2, 'player_id': 1, 'score': 17},
+        {'game_id': 3, 'player_id': 2, 'score': 22},
+        {'game_id': 4, 'player_id': 2, 'score': 41},
+        {'game_id': 5, 'player_id': 1, 'score': 34}
+    ]
+
+    def order(row):
+        return row.get('game_id', -1), row['player_id']
+
+    for joiner in [InnerJoiner(), OuterJoiner(), LeftJoiner(), RightJoiner()]:
+        merged = list(Join(joiner, keys=['player_id'], strategy='sort')(
+            games, players))
+        # hash join is opt-in, so by default output is sorted by keys
+        assert merged == list(Join(joiner, keys=['player_id'])(
+            games, players))
+        etalon = sorted(merged, key=order)
+        for hash_join in [Join(joiner, keys=['player_id'], strategy='hash'),
+                          Join(joiner, keys=['player_id'], size_hint=3),
+                          Join(joiner, keys=['player_id'], size_hint=10,
+                               hash_join_limit=5)]:
+            assert etalon == sorted(hash_join(games, players), key=order)
+
+
+def test_join_unknown_strategy():
+    with raises(ValueError):
+        Join(InnerJoiner(), keys=['k'], strategy='hsah')
+
+
+def test_join_then_reduce_without_sort():
+    left = [{'k': k} for k in [3, 1, 2, 1, 3]]
+    right = [{'k': k, 'v': v}
+             for k, v in [(1, 'a'), (2, 'b'), (3, 'c'), (1, 'd'), (2, 'e')]]
+
+    etalon = [{'k': 1, 'n': 4}, {'k': 2, 'n': 2}, {'k': 3, 'n': 2}]
+    rows = Join(InnerJoiner(), keys=['k'])(left, right)
+    assert etalon == list(Reduce(Count('n'), keys=['k'])(rows))
+
+
+def test_hash_join_keeps_groups_of_custom_joiners():
+    class GroupSizes(Joiner):
+        def __call__(self, keys, rows_a, rows_b):
+            if rows_a is not None and rows_b is not None:
+                rows_a, rows_b = list(rows_a), list(rows_b)
+                yield {'k': rows_a[0]['k'], 'sizes': (len(rows_a),
+                                                      len(rows_b))}
+
+    left = [{'k': k} for k in [1, 2, 1]]
+    right = [{'k': k} for k in [1, 1, 2]]
+    etalon = [{'k': 1, 'sizes': (2, 2)}, {'k': 2, 'sizes': (1, 1)}]
+    for strategy in ['auto', 'hash']:
+        assert etalon == list(Join(GroupSizes(), keys=['k'],
+                                   strategy=strategy, size_hint=3)(
+            left, right))
+
+
+def test_fused_map():
+    class Duplicate(Mapper):
+        def __call__(self, row):
+            yield dict(row, copy=1)
+            yield dict(row, copy=2)
+
+    class Enumerate(Mapper):
+        # changes the row in place and yields it several times
+        def __call__(self, row):
+            for i in range(3):
+                row['i'] = i
+                yield row
+
+    def mappers():
+        return [FilterPunctuation('text'), LowerCase('text'), Split('text'),
+                Filter(lambda row: len(row['text']) > 2), Duplicate(),
+                Enumerate(), Project(['text', 'copy', 'i'])]
+
+    tests = [
+        {'test_id': 1, 'text': 'One, two... THREE'},
+        {'test_id': 2, 'text': 'testing out stuff'}
+    ]
+
+    etalon = [dict(row) for row in tests]
+    for mapper in mappers():
+        etalon = Map(mapper)(etalon)
+    etalon = list(etalon)
+    assert [0, 1, 2] == [row['i'] for row in etalon[:3]]
+
+    result = FusedMap(mappers())([dict(row) for row in tests])
+
+    assert etalon == list(result)
+
+
+def test_hash_aggregate():
+    matches = [
+        {'match_id': 2, 'player_id': 5, 'score': 15},
+        {'match_id': 1, 'player_id': 1, 'score': 42},
+        {'match_id': 2, 'player_id': 6, 'score': 39},
+        {'match_id': 1, 'player_id': 2, 'score': 7},
+        {'match_id': 1, 'player_id': 3, 'score': 0},
+        {'match_id': 2, 'player_id': 7, 'score': 27},
+        {'match_id': 1, 'player_id': 4, 'score': 39},
+        {'match_id': 2, 'player_id': 8, 'score': 7}
+    ]
+
+    etalon = [
+        {'match_id': 2, 'count': 4, 'score': 88},
+        {'match_id': 1, 'count': 4, 'score': 88}
+    ]
+
+    result = HashAggregate([Count('count'), Sum('score')],
+                           keys=['match_id'])(matches)
+
+    assert etalon == list(result)
+
+    average = Reduce(Average('score'), keys=['match_id'])(
+        sorted(matches, key=itemgetter('match_id')))
+    assert list(average) == sorted(
+        HashAggregate([Average('score')], keys=['match_id'])(matches),
+        key=itemgetter('match_id'))
+
+
+def test_parse_timestamp():
+    rows = [
+        {'time': '20171020T112238.723000'},
+        {'time': '20171022T131828'},
+        {'time': '19700101T000001.5'},
+        {'time': '20171020T112238.723000'}
+    ]
+
+    etalon = [
+        {'time': '20171020T112238.723000', 'microseconds': 1508498558723000,
+         'weekday': 'Fri', 'hour': 11},
+        {'time': '20171022T131828', 'microseconds': 1508678308000000,
+         'weekday': 'Sun', 'hour': 13},
+        {'time': '19700101T000001.5', 'microseconds': 1500000,
+         'weekday': 'Thu', 'hour': 0},
+        {'time': '20171020T112238.723000', 'microseconds': 1508498558723000,
+         'weekday': 'Fri', 'hour': 11}
+    ]
+
+    for memoize in [0, 2]:
+        mapper = ParseTimestamp('time', 'microseconds', 'weekday', 'hour',
+                                memoize=memoize)
+        result = Map(mapper)(dict(row) for row in rows)
+        assert etalon == list(result)
+
+    for timestamp in ['20171020X112238', '20171020T1122',
+                      '20171020T112238,5', '20171020T112238.1234567']:
+        with raises(ValueError):
+            ParseTimestamp.parse(timestamp)
+
+
+def test_read_from_file(tmp_path):
+    rows = [{'id': i, 'text': 'line {}'.format(i), 'extra': [i]}
+            for i in range(100)]
+    path = tmp_path / 'rows.txt'
+    path.write_text(''.join(json.dumps(row) + '\n' for row in rows) + '\n')
+
+    assert list(ReadFromFile(json.loads, block_size=256)(str(path))) == rows
+
+    result = ReadFromFile(json.loads, block_size=256,
+                          fields=['text', 'id'])(str(path))
+    assert list(result) == [{'text': row['text'], 'id': row['id']}
+                            for row in rows]
+
+    result = ReadFromFile(lambda line: {'line': line})(str(path))
+    assert len(list(result)) == len(rows) + 1
+
+
+def test_reduce_memory_limit():
+    rows = [{'doc_id': i // 30, 'text': 'word {}'.format(i % 7)}
+            for i in range(100)]
+
+    for reducer in [TermFrequency('text'), RowsCounter('count')]:
+        etalon = list(Reduce(reducer, keys=['doc_id'])(rows))
+        result = Reduce(reducer, keys=['doc_id'], memory_limit=1000)(rows)
+        assert etalon == list(result)
+
+    etalon = list(CountAll(RowsCounter('count'), keys=[])(rows))
+    result = CountAll(RowsCounter('count'), keys=[], memory_limit=1000)(rows)
+    assert etalon == list(result)
+
+
+def test_compact_rows():
+    docs = [{'doc_id': 1, 'text': 'hello little world'},
+            {'doc_id': 2, 'text': 'little'}]
+    lengths = [{'text': 'hello', 'length': 5}, {'text': 'little', 'length': 6}]
+    mappers = [Split('text'), ApplyFunction(lambda row: len(row['text']),
+                                            'size'),
+               LowerCase('text'), Project(['text', 'doc_id', 'size'])]
+
+    etalon = list(FusedMap(mappers)(dict(row) for row in docs))
+    result = list(FusedMap([Compact()] + mappers)(dict(row) for row in docs))
+
+    assert all(isinstance(row, CompactRow) for row in result)
+    assert etalon == [row.to_dict() for row in result]
+    assert result[0].schema is result[-1].schema
+    assert pickle.loads(pickle.dumps(result[0])).schema is result[0].schema
+
+    etalon = list(Join(InnerJoiner(), ['text'])(etalon, lengths))
+    result = list(Join(InnerJoiner(), ['text'])(result, lengths))
+    assert etalon == [row.to_dict() for row in result]
+
+
+def test_sort_descending():
+    rows = [{'a': i % 3, 'b': i % 5, 'id': i} for i in range(30)]
+
+    etalon = sorted(rows, key=lambda row: (row['a'], -row['b']))
+    for memory_limit in [None, 500]:
+        result = Sort(['a', 'b'], memory_limit=memory_limit,
+                      descending=['b'])(rows)
+        assert etalon == list(result)
+
+    etalon = sorted(rows, key=itemgetter('b', 'a'), reverse=True)
+    for memory_limit in [None, 500]:
+        result = Sort(['b', 'a'], memory_limit=memory_limit,
+                      descending=['a', 'b'])(rows)
+        assert etalon == list(result)
+
+    assert Sort(['a', 'b'], descending=['b']).ordering(()) == ('a',)
+    assert key_extractor(['a', 'b']) is key_extractor(('a', 'b'))
+    assert key_extractor(['a'])(rows[4]) == 1
+    assert key_extractor(['a'], as_tuple=True)(rows[4]) == (1,)
+
+
+def test_top_k():
+    rows = [{'key': i % 4, 'value': i % 7, 'id': i} for i in range(50)]
+
+    etalon = []
+    for key in range(4):
+        group = [row for row in rows if row['key'] == key]
+        etalon.extend(sorted(group, key=itemgetter('value'), reverse=True)[:3])
+    assert etalon == list(TopK('value', 3, keys=['key'])(rows))
+    assert etalon == list(Reduce(TopN('value', 3), keys=['key'])(
+        sorted(rows, key=itemgetter('key'))))
+
+    etalon = sorted(rows, key=itemgetter('value'), reverse=True)[:5]
+    assert etalon == list(TopK('value', 5)(rows))
+    assert [] == list(TopK('value', 0)(rows))
+
+
+def test_streaming_reducers():
+    rows = [{'doc_id': i // 30, 'text': 'word {}'.format(i % 7)}
+            for i in range(100)]
+
+    class GroupType(Reducer):
+        streaming = True
+
+        def __call__(self, group_key, rows):
+            yield {'list': isinstance(rows, list)}
+
+    assert not any(row['list'] for row in
+                   Reduce(GroupType(), keys=['doc_id'])(iter(rows)))
+    assert not Reduce(Count('count'), keys=['doc_id']).buffers_rows
+    assert not Reduce(TopN('doc_id', 1), keys=['doc_id']).buffers_rows
+    assert Reduce(TermFrequency('text'), keys=['doc_id']).buffers_rows
+
+    etalon = [{'doc_id': row['doc_id'], 'count': 100} for row in rows]
+    assert etalon == list(CountAll(RowsCounter('count'),
+                                   keys=['doc_id'])(iter(rows)))
+    etalon = [{'doc_id': row['doc_id'], 'count': 30 if row['doc_id'] < 3
+               else 10} for row in rows]
+    assert etalon == list(Reduce(RowsCounter('count'),
+                                 keys=['doc_id'])(iter(rows)))
+
+
+def test_join_skewed_groups():
+    # 'the' makes a group of 40 x 60 rows
+    left = [{'text': 'the' if i % 5 else 'word {}'.format(i), 'doc_id': i}
+            for i in range(50)]
+    right = [{'text': 'the' if i % 4 else 'word {}'.format(i), 'line': i}
+             for i in range(80)]
+
+    etalon = list(Join(InnerJoiner(), ['text'], strategy='sort')(
+        left, right))
+    assert len(etalon) == 40 * 60 + 3
+    for memory_limit, spilled_groups in [(2000, 1), (None, 0)]:
+        stats = JoinStats(top=2)
+        result = Join(InnerJoiner(), ['text'], strategy='sort',
+                      memory_limit=memory_limit, stats=stats)(left, right)
+        # spilling keeps order of rows
+        assert etalon == list(result)
+        assert stats.groups == 4
+        assert stats.products == len(etalon)
+        assert stats.heaviest[0] == (('the',), 40, 60)
+        assert stats.spilled_groups == spilled_groups
+
+    for strategy in ['auto', 'hash']:
+        stats = JoinStats()
+        result = Join(InnerJoiner(), ['text'], strategy=strategy,
+                      size_hint=80, stats=stats)(left, right)
+        assert etalon == list(result)
+        assert stats.groups == 4
+        assert stats.products == len(etalon)
+
+
+def test_join_keeps_order_of_pairs():
+    left = [{'text': 'the', 'doc_id': i} for i in range(3)]
+    right = [{'text': 'the', 'line': i} for i in range(60)]
+
+    etalon = list(Join(InnerJoiner(), ['text'], strategy='sort')(
+        left, right))
+    assert [(0, 0), (0, 1)] == [(row['doc_id'], row['line'])
+                                for row in etalon[:2]]
+    stats = JoinStats()
+    result = Join(InnerJoiner(), ['text'], strategy='sort',
+                  memory_limit=2000, stats=stats)(left, right)
+    # only the left group fits, but pairs are in order of left rows still
+    assert etalon == list(result)
+    assert stats.spilled_groups == 1
+
+
+def test_merge_row_layout():
+    left = {'doc_id': 1, 'text': 'a', 'count': 3, 'score': 1}
+    right = {'doc_id': 1, 'text': 'a', 'total': 5, 'score': 2}
+    joiner = InnerJoiner()
+
+    etalon = {'score_1': 1, 'score_2': 2, 'count': 3, 'total': 5,
+              'doc_id': 1, 'text': 'a'}
+    for _ in range(2):
+        result, = joiner._merge_row(['doc_id', 'text'], left, right)
+        assert list(etalon.items()) == list(result.items())
+    result, = joiner._merge_row(['doc_id', 'text'],
+                                CompactRow.from_dict(left), right)
+    assert isinstance(result, CompactRow)
+    assert list(etalon.items()) == list(result.items())
+
+
+def test_sort_merges_runs_in_passes(monkeypatch):
+    rows = [{'key': (i * 7) % 13, 'id': i} for i in range(300)]
+
+    sort = Sort(['key'], memory_limit=500)
+    sort.max_merged_runs = 3
+    spilled, _ = sort._sorted_runs(rows, itemgetter('key'), False)
+    assert len(spilled) < 3
+    for spill_file in spilled:
+        spill_file.close()
+
+    written = []
+    spill = operations._spill
+
+    def counting_spill(spilled_rows):
+        spilled_rows = list(spilled_rows)
+        written.extend(spilled_rows)
+        return spill(spilled_rows)
+
+    monkeypatch.setattr(operations, '_spill', counting_spill)
+    assert sorted(rows, key=itemgetter('key')) == list(sort(rows))
+    # ~150 runs merged in tiers of 3: every row is written a few times
+    assert len(written) < 8 * len(rows)
+
+
+def test_join_unhashable_keys():
+    points = [{'pt': [1, 2], 'name': 'a'}, {'pt': [3, 4], 'name': 'b'}]
+    lengths = [{'pt': [3, 4], 'length': 5}, {'pt': [1, 2], 'length': 2}]
+
+    etalon = [{'pt': [1, 2], 'name': 'a', 'length': 2},
+              {'pt': [3, 4], 'name': 'b', 'length': 5}]
+    for size_hint in [None, 2]:
+        result = Join(InnerJoiner(), ['pt'], size_hint=size_hint)(
+            points, lengths)
+        assert etalon == sorted(result, key=itemgetter('pt'))
+        result = Join(LeftJoiner(), ['pt'], size_hint=size_hint)(points, [])
+        assert points == list(result)
+
+
+def test_aggregators_of_empty_input():
+    for aggregator in [Count('count'), Sum('x'), Average('x')]:
+        assert [] == list(aggregator(('a',), []))
+        assert [] == list(Reduce(aggregator, keys=['a'])([]))
+        assert [] == list(CountAll(aggregator, keys=[])([]))
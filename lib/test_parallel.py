@@ -0,0 +1,104 @@
+import json
+from operator import itemgetter
+
+from .graph import Graph
+from .operations import Map, ApplyFunction, Split, Reduce, Sort, Count, \
+    FilterPunctuation, LowerCase, Sum, HashAggregate
+from .parallel import ParallelMap, ParallelReduce, ParallelAggregate, \
+    ParallelReadFromFile, byte_ranges
+
+
+def test_parallel_map():
+    offset = 10
+
+    rows = [{'test_id': i, 'text': 'one two three'} for i in range(100)]
+
+    mapper = ApplyFunction(lambda row: row['test_id'] + offset, 'shifted')
+    etalon = list(Map(mapper)(dict(row) for row in rows))
+
+    result = ParallelMap(mapper, workers=2, chunk_size=7)(rows)
+
+    assert etalon == list(result)
+
+
+def test_parallel_map_unordered():
+    rows = [{'test_id': i, 'text': 'one two three'} for i in range(100)]
+
+    etalon = list(Map(Split('text'))(dict(row) for row in rows))
+
+    result = ParallelMap(Split('text'), workers=3, ordered=False,
+                         chunk_size=9)(rows)
+
+    order = itemgetter('test_id', 'text')
+    assert sorted(etalon, key=order) == sorted(result, key=order)
+
+
+def test_parallel_reduce():
+    words = 'one two three four five six'.split() * 20
+    rows = [{'doc_id': i % 7, 'text': word} for i, word in enumerate(words)]
+
+    etalon = list(Reduce(Count('count'), keys=['text', 'doc_id'])(
+        Sort(['text', 'doc_id'])(rows)))
+
+    result = ParallelReduce(Count('count'), keys=['text', 'doc_id'],
+                            workers=3)(rows)
+
+    assert etalon == list(result)
+
+
+def test_parallel_reduce_in_graph():
+    docs = [
+        {'doc_id': 1, 'text': 'hello, my little WORLD'},
+        {'doc_id': 2, 'text': 'Hello, my little little hell'}
+    ]
+
+    etalon = [
+        {'count': 1, 'text': 'hell'},
+        {'count': 2, 'text': 'hello'},
+        {'count': 3, 'text': 'little'},
+        {'count': 2, 'text': 'my'},
+        {'count': 1, 'text': 'world'}
+    ]
+
+    graph = Graph().read_from_iter('docs') \
+        .map(FilterPunctuation('text')) \
+        .map(LowerCase('text')) \
+        .map(Split('text')) \
+        .sort(['text']) \
+        .reduce(Count('count'), keys=['text'], workers=2)
+
+    assert etalon == graph.run(docs=docs)
+
+
+def test_parallel_aggregate():
+    words = 'one two three four five six'.split() * 20
+    rows = [{'doc_id': i % 7, 'text': word} for i, word in enumerate(words)]
+
+    etalon = list(HashAggregate([Count('count'), Sum('doc_id')],
+                                keys=['text'])(rows))
+
+    result = ParallelAggregate([Count('count'), Sum('doc_id')],
+                               keys=['text'], workers=3, chunk_size=11)(rows)
+
+    assert etalon == list(result)
+
+
+def test_parallel_read_from_file(tmp_path):
+    rows = [{'id': i, 'text': 'line ' * (i % 7)} for i in range(200)]
+    path = tmp_path / 'rows.txt'
+    path.write_text(''.join(json.dumps(row) + '\n' for row in rows))
+
+    ranges = byte_ranges(str(path), shard_size=100)
+    assert ranges[0][0] == 0 and ranges[-1][1] == path.stat().st_size
+    assert all(end == start for (_, end), (start, _)
+               in zip(ranges, ranges[1:]))
+
+    result = ParallelReadFromFile(json.loads, workers=3,
+                                  shard_size=100)(str(path))
+    assert list(result) == rows
+
+    graph = Graph().read_from_file('rows', json.loads, fields=['id'],
+                                   workers=2, ordered=False)
+    result = graph.run(rows=str(path))
+    assert sorted(result, key=itemgetter('id')) == \
+        [{'id': row['id']} for row in rows]
@@ -0,0 +1,31 @@
+from .cache import MaterializationCache
+from .graph import Graph
+from .operations import Count, InnerJoiner, Split
+from .optimizer import count_consumers
+from .profiling import Profiler
+
+
+def test_profile_counts_rows(capsys):
+    docs = [{'doc_id': i, 'text': 'a b c a'} for i in range(10)]
+    words = Graph().read_from_iter('docs').map(Split('text'))
+    counts = words.sort(['text']).reduce(Count('count'), ['text'])
+    graph = words.sort(['text']).join(InnerJoiner(), counts, ['text'])
+
+    profiler = Profiler()
+    cache = MaterializationCache(count_consumers(graph))
+    result = list(graph.run_recursively({'docs': docs}, cache, profiler))
+    assert len(result) == 40
+
+    stats = {node_stats.label: node_stats
+             for node_stats in profiler.stats.values()}
+    assert stats["Read('docs')"].rows_out == 10
+    split = stats["Map(mapper=Split(column='text'))"]
+    assert (split.rows_in, split.rows_out) == (10, 40)
+    reduce = stats["Reduce(reducer=Count(column='count'), keys=['text'])"]
+    assert (reduce.rows_in, reduce.rows_out) == (40, 3)
+    assert all(node_stats.self_time >= 0
+               for node_stats in profiler.stats.values())
+
+    graph.run(docs=docs, profile=True)
+    report = capsys.readouterr().out
+    assert 'Profile:' in report and 'Join(' in report